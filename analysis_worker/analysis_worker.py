@@ -0,0 +1,417 @@
+#!/usr/bin/env python3.8
+
+"""
+Analysis worker receives analysis requests from the gateway and searches
+the current position of the requested game for the best move. The result
+is written to the game stream as an analysis game event.
+
+Positions are searched by iterative deepening alpha-beta over legal moves
+of the board. Each depth is split by root moves across a pool of worker
+processes, which are handed immutable positions. Search stops at the first
+of the depth, node and time budgets, so the cost of a request is bounded
+no matter the position. Budgets of a request may only lower the limits
+of the analysis worker.
+
+Any amount of analysis workers may run side by side, as members of a Redis
+consumer group. Requests left unacknowledged by a crashed analysis worker
+are taken over by another one once they have been idle for long enough.
+
+When games are spread across multiple redis nodes, each node holds its own
+analysis stream, and analysis workers serve the single node of REDIS_HOST.
+
+Metrics are served in prometheus text format on a side port.
+"""
+
+import os
+import time
+import socket
+import logging
+import multiprocessing
+from typing import List, Dict, Tuple, Optional
+from concurrent.futures import ProcessPoolExecutor
+from redis import Redis, ConnectionPool, ResponseError
+from prometheus_client import start_http_server
+from chess_utils import ChessBoard, BoardMove, Position, AnalysisGameEvent, game_exists, write_event_to_game, RoundTripConnection, \
+    metrics_registry, ANALYSIS_SECONDS, ANALYSIS_NODES, SQUARES, PAWN, KNIGHT, BISHOP, KING, WHITE
+
+logging.basicConfig(level=logging.DEBUG)
+redis = Redis(connection_pool=ConnectionPool(host=os.getenv("REDIS_HOST", "localhost"),
+                                             port=int(os.getenv("REDIS_PORT", "6379")),
+                                             db=0,
+                                             decode_responses=True,
+                                             connection_class=RoundTripConnection))
+
+ANALYSIS_STREAM_NAME = os.getenv("ANALYSIS_STREAM_NAME", "analysis")
+ANALYSIS_GROUP_NAME = os.getenv("ANALYSIS_GROUP_NAME", "analysis_worker")
+ANALYSIS_CONSUMER_NAME = os.getenv(
+    "ANALYSIS_CONSUMER_NAME", f"{socket.gethostname()}-{os.getpid()}")
+ANALYSIS_RECLAIM_TIMEOUT = int(os.getenv("ANALYSIS_RECLAIM_TIMEOUT", "60000"))
+MOVE_LEDGER = os.getenv("MOVE_LEDGER", "false") == "true"
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", str(os.cpu_count() or 1)))
+ANALYSIS_MAX_DEPTH = int(os.getenv("ANALYSIS_MAX_DEPTH", "4"))
+ANALYSIS_MAX_NODES = int(os.getenv("ANALYSIS_MAX_NODES", "200000"))
+ANALYSIS_MAX_TIME = int(os.getenv("ANALYSIS_MAX_TIME", "5000"))
+ANALYSIS_TABLE_SIZE = int(os.getenv("ANALYSIS_TABLE_SIZE", "200000"))
+ANALYSIS_METRICS_PORT = int(os.getenv("ANALYSIS_METRICS_PORT", "8003"))
+
+# pool of worker processes, started once the first position is split
+executor: Optional[ProcessPoolExecutor] = None
+
+# scores are in centipawns from the view of the side to move. mate scores
+# count down with the plies it takes to deliver the mate
+MATE = 100000
+MATE_THRESHOLD = MATE - 1000
+
+# piece values by piece kind, kings are never captured by legal moves
+PIECE_VALUES = [0, 100, 320, 330, 500, 900, 0]
+
+# transposition table bounds
+EXACT, LOWER, UPPER = 0, 1, 2
+
+# nodes searched between updates of the shared node budget
+NODE_BATCH = 64
+
+
+def _square_value(piece: int, sq: int) -> int:
+    """Value of a piece on a square, positive for white pieces."""
+
+    kind, x, y = piece & 7, sq & 7, sq >> 4
+
+    # 0 on the edge of the board, 3 in its centre
+    centre = int(3.5 - max(abs(x - 3.5), abs(y - 3.5)))
+
+    value = PIECE_VALUES[kind]
+    if kind in (KNIGHT, BISHOP):
+        value += 10 * centre
+    elif kind == PAWN:
+        value += 5 * ((6 - y) if piece & WHITE else (y - 1)) + 5 * centre
+
+    return value if piece & WHITE else -value
+
+
+# value of each piece code on each 0x88 square
+SQUARE_VALUES = [[_square_value(piece, sq) if 0 < piece & 7 <= KING else 0 for sq in range(0, 128)]
+                 for piece in range(0, 16)]
+
+# search results by position hash, kept by each process across searches
+transpositions: Dict[int, Tuple[int, int, int, Optional[BoardMove]]] = {}
+
+# nodes left to the running analysis, shared by all worker processes
+nodes_left = multiprocessing.Value("q", 0)
+
+
+def _init_worker(budget):
+    """Hands shared node budget over to a worker process."""
+
+    global nodes_left
+    nodes_left = budget
+
+
+class SearchAborted(Exception):
+    """Search ran out of its node or time budget."""
+
+
+class Search:
+
+    """
+    Alpha-beta search of a single board, bounded by the shared node
+    budget and a deadline. Board is left mid-search once budget runs out.
+    """
+
+    def __init__(self, board: ChessBoard, deadline: float,
+                 table: Dict[int, Tuple[int, int, int, Optional[BoardMove]]]) -> None:
+        self.board = board
+        self.deadline = deadline
+        self.table = table
+        self.nodes = 0
+
+    def evaluate(self) -> int:
+        """Static evaluation of the position from the view of the side to move."""
+
+        squares = self.board._squares
+        score = sum(SQUARE_VALUES[squares[sq]][sq] for sq in SQUARES)
+
+        return score if self.board.is_white_turn() else -score
+
+    def moves(self, first: Optional[BoardMove] = None, captures: bool = False) -> List[BoardMove]:
+        """
+        Legal moves of the side to move, ordered so that the most promising
+        ones are searched first: given move, then captures by most valuable
+        victim and least valuable attacker, then the rest.
+        """
+
+        squares = self.board._squares
+        moves = [BoardMove(src, dest) for src, dests in self.board.legal_moves().items() for dest in dests
+                 if not captures or squares[dest]]
+
+        moves.sort(key=lambda m: -(PIECE_VALUES[squares[m.dest] & 7] * 8 - (squares[m.src] & 7))
+                   if squares[m.dest] else 0)
+
+        if first is not None and first in moves:
+            moves.remove(first)
+            moves.insert(0, first)
+
+        return moves
+
+    def _visit(self):
+
+        self.nodes += 1
+
+        # shared budget is drawn from in batches, so processes rarely wait on its lock
+        if not self.nodes % NODE_BATCH:
+            with nodes_left.get_lock():
+                nodes_left.value -= NODE_BATCH
+                if nodes_left.value <= 0:
+                    raise SearchAborted()
+
+        if time.time() > self.deadline:
+            raise SearchAborted()
+
+    def quiesce(self, alpha: int, beta: int) -> int:
+        """Searches captures only, so that leaves are not evaluated mid exchange."""
+
+        self._visit()
+
+        score = self.evaluate()
+        if score >= beta:
+            return score
+        alpha = max(alpha, score)
+
+        for move in self.moves(captures=True):
+
+            self.board.make(move)
+            score = max(score, -self.quiesce(-beta, -alpha))
+            self.board.unmake()
+
+            if score >= beta:
+                break
+            alpha = max(alpha, score)
+
+        return score
+
+    def search(self, depth: int, alpha: int, beta: int, ply: int) -> int:
+        """Negamax alpha-beta search, returns score of the side to move."""
+
+        if depth <= 0:
+            return self.quiesce(alpha, beta)
+
+        self._visit()
+
+        board = self.board
+        entry = self.table.get(board.hash)
+        first = None
+
+        if entry:
+            entry_depth, score, bound, first = entry
+
+            # mate scores depend on the ply they were found at, so only their moves are reused
+            if entry_depth >= depth and abs(score) < MATE_THRESHOLD and (
+                    bound == EXACT or (bound == LOWER and score >= beta) or (bound == UPPER and score <= alpha)):
+                return score
+
+        moves = self.moves(first)
+
+        # checkmate or stalemate
+        if not moves:
+            return -MATE + ply if board.is_in_check(board.is_white_turn()) else 0
+
+        best, best_move, original_alpha = -MATE, None, alpha
+
+        for move in moves:
+
+            board.make(move)
+            score = -self.search(depth - 1, -beta, -alpha, ply + 1)
+            board.unmake()
+
+            if score > best:
+                best, best_move = score, move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                break
+
+        bound = UPPER if best <= original_alpha else LOWER if best >= beta else EXACT
+        self.table[board.hash] = (depth, best, bound, best_move)
+
+        return best
+
+
+def search_move(position: Position, move: BoardMove, depth: int, deadline: float) -> Tuple[Optional[int], int]:
+    """
+    Searches position following a root move to given depth.
+    Returns score from the view of the side making the move, None if
+    search ran out of budget, along with the amount of searched nodes.
+    """
+
+    # transposition table is kept in check by starting over once it fills up
+    if len(transpositions) > ANALYSIS_TABLE_SIZE:
+        transpositions.clear()
+
+    # budget ran out while move was waiting for its turn
+    if nodes_left.value <= 0:
+        return None, 0
+
+    search = Search(ChessBoard.from_position(position.make(move)), deadline, transpositions)
+
+    try:
+        score = -search.search(depth - 1, -MATE, MATE, 1)
+    except SearchAborted:
+        score = None
+
+    # nodes short of a full batch are drawn once search is done
+    with nodes_left.get_lock():
+        nodes_left.value -= search.nodes % NODE_BATCH
+
+    return score, search.nodes
+
+
+def search_moves(position: Position, moves: List[BoardMove], depth: int, deadline: float) -> List[Tuple[Optional[int], int]]:
+    """Searches root moves concurrently, unless there are not enough workers to split them."""
+
+    global executor
+
+    args = ([position] * len(moves), moves, [depth] * len(moves), [deadline] * len(moves))
+
+    if len(moves) < 2 or ANALYSIS_WORKERS < 2:
+        return list(map(search_move, *args))
+
+    if executor is None:
+        executor = ProcessPoolExecutor(ANALYSIS_WORKERS, initializer=_init_worker, initargs=(nodes_left,))
+
+    return list(executor.map(search_move, *args))
+
+
+def analyse(position: Position, depth: int, nodes: int, seconds: float) -> Tuple[int, Optional[BoardMove], int, int]:
+    """
+    Searches position by iterative deepening until one of the budgets runs out.
+    Node budget is shared by root moves of all depths, across processes.
+    Returns score from the view of the side to move along with the best
+    move, the last fully searched depth and the amount of searched nodes.
+    """
+
+    deadline = time.time() + seconds
+    nodes_left.value = nodes
+    root = Search(ChessBoard.from_position(position), deadline, {})
+    moves = root.moves()
+
+    # game is already over
+    if not moves:
+        return (-MATE if root.board.is_in_check(position.white_to_move) else 0), None, 0, 0
+
+    score, best_move, depth_reached, searched = root.evaluate(), None, 0, 0
+
+    for current in range(1, depth + 1):
+
+        if nodes_left.value <= 0 or time.time() >= deadline:
+            break
+
+        results = search_moves(position, moves, current, deadline)
+        searched += sum(n for _, n in results)
+
+        # depth is only trusted once all of its root moves were searched
+        if any(s is None for s, _ in results):
+            break
+
+        # best moves of this depth are searched first on the next one
+        order = sorted(range(0, len(moves)), key=lambda i: -results[i][0])
+        moves = [moves[i] for i in order]
+        score, best_move, depth_reached = results[order[0]][0], moves[0], current
+
+        # no shorter mate is left to find
+        if abs(score) >= MATE_THRESHOLD:
+            break
+
+    return score, best_move, depth_reached, searched
+
+
+def mate_in(score: int) -> Optional[int]:
+    """Moves until mate out of a mate score, negative if side to move is mated, 0 if it already is."""
+
+    if abs(score) < MATE_THRESHOLD:
+        return None
+
+    moves = (MATE - abs(score) + 1) // 2
+    return moves if score > 0 else -moves
+
+
+def create_group():
+    """Creates consumer group on the analysis stream, unless it already exists."""
+
+    try:
+        redis.xgroup_create(ANALYSIS_STREAM_NAME, ANALYSIS_GROUP_NAME,
+                            id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def handle_request(message_ts: str, fields: Optional[dict]):
+    """
+    Analyses current position of the requested game and writes the result
+    to the game stream. Request is acknowledged and removed either way.
+    """
+
+    # fields are missing if message was deleted before being acknowledged
+    game_id = int(fields["game_id"]) if fields else None
+
+    if game_id is None or not game_exists(game_id, redis):
+        logging.warning("received analysis request for non-existing game (id %s)", game_id)
+
+    else:
+
+        # request may only lower the budgets
+        depth = min(int(fields.get("depth", ANALYSIS_MAX_DEPTH)), ANALYSIS_MAX_DEPTH)
+        nodes = min(int(fields.get("nodes", ANALYSIS_MAX_NODES)), ANALYSIS_MAX_NODES)
+        seconds = min(int(fields.get("time", ANALYSIS_MAX_TIME)), ANALYSIS_MAX_TIME) / 1000
+
+        board = ChessBoard.from_redis(game_id, redis, ledger=MOVE_LEDGER)
+
+        start = time.perf_counter()
+        score, best_move, depth, nodes = analyse(board.to_position(), depth, nodes, seconds)
+        ANALYSIS_SECONDS.observe(time.perf_counter() - start)
+        ANALYSIS_NODES.observe(nodes)
+
+        # scores are reported from the view of white
+        sign = 1 if board.is_white_turn() else -1
+        mate = mate_in(score)
+        event = AnalysisGameEvent(ply=board.ply, depth=depth, nodes=nodes, score=sign * score,
+                                  mate=sign * mate if mate is not None else None,
+                                  best_move=best_move.to_move() if best_move else None)
+
+        write_event_to_game(game_id, redis, event)
+        logging.info("game id %s: new event: %s", game_id, event)
+
+    # acknowledge and remove request at once
+    pipeline = redis.pipeline()
+    pipeline.xack(ANALYSIS_STREAM_NAME, ANALYSIS_GROUP_NAME, message_ts)
+    pipeline.xdel(ANALYSIS_STREAM_NAME, message_ts)
+    pipeline.execute()
+
+
+def main():
+
+    logging.info("awaiting analysis requests")
+
+    if ANALYSIS_METRICS_PORT:
+        start_http_server(ANALYSIS_METRICS_PORT, registry=metrics_registry())
+
+    create_group()
+
+    while True:
+
+        # requests left behind by crashed analysis workers come first
+        messages = redis.xautoclaim(ANALYSIS_STREAM_NAME, ANALYSIS_GROUP_NAME, ANALYSIS_CONSUMER_NAME,
+                                    min_idle_time=ANALYSIS_RECLAIM_TIMEOUT, start_id="0-0", count=1)[1]
+
+        # requests are taken one at a time, so they spread across analysis workers
+        if not messages:
+            messages = redis.xreadgroup(ANALYSIS_GROUP_NAME, ANALYSIS_CONSUMER_NAME,
+                                        {ANALYSIS_STREAM_NAME: ">"}, count=1, block=1000)
+            messages = messages[0][1] if messages else []
+
+        for message_ts, fields in messages:
+            handle_request(message_ts, fields)
+
+
+if __name__ == "__main__":
+    main()
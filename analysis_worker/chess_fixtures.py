@@ -0,0 +1 @@
+../utils/chess_fixtures.py
\ No newline at end of file
@@ -0,0 +1 @@
+../utils/chess_utils.py
\ No newline at end of file
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3.8
+
+import analysis_worker
+from analysis_worker import redis as app_redis, analyse, mate_in
+from redis import Redis
+from chess_utils import ChessBoard, BoardMove, Move, Coordinate, EventTypes, square, init_game, expire_game, \
+    write_event_to_analysis_worker, stream_key_from_id, decode_game_event, parse_game_event
+from chess_fixtures import HANGING_QUEEN, FOOLS_MATE, write_moves
+
+redis: Redis = app_redis
+
+
+def test_analyse(monkeypatch):
+
+    # prepare vars
+    monkeypatch.setattr(analysis_worker, "ANALYSIS_WORKERS", 1)
+    position = ChessBoard.from_fen("6k1/5ppp/8/8/8/8/8/R5K1 w - - 0 1").to_position()
+
+    # assert back rank mate is found, and deepening stops right away
+    score, best_move, depth, nodes = analyse(position, 4, 100000, 60)
+    assert best_move == BoardMove(square(0, 7), square(0, 0))
+    assert mate_in(score) == 1 and depth == 2
+
+    # assert search stays within its node budget
+    score, best_move, depth, nodes = analyse(ChessBoard().to_position(), 4, 500, 60)
+    assert depth < 4 and nodes <= 500 + analysis_worker.NODE_BATCH
+
+    # assert mated side has nothing left to search
+    mated = ChessBoard.from_fen("R5k1/5ppp/8/8/8/8/8/6K1 b - - 0 1").to_position()
+    assert analyse(mated, 4, 100000, 60) == (-analysis_worker.MATE, None, 0, 0)
+    assert mate_in(-analysis_worker.MATE) == 0
+
+
+def test_handle_request(monkeypatch):
+
+    # prepare vars
+    game_id = 1
+    monkeypatch.setattr(analysis_worker, "ANALYSIS_STREAM_NAME", "test-analysis")
+    monkeypatch.setattr(analysis_worker, "ANALYSIS_WORKERS", 2)
+    analysis_worker.create_group()
+    init_game(game_id, redis)
+
+    # white queen is left hanging
+    write_moves(game_id, redis, HANGING_QUEEN)
+
+    # request analysis and handle it across worker processes
+    write_event_to_analysis_worker(game_id, redis, "test-analysis", depth=2)
+    messages = redis.xreadgroup(analysis_worker.ANALYSIS_GROUP_NAME,
+                                analysis_worker.ANALYSIS_CONSUMER_NAME, {"test-analysis": ">"}, count=1)
+    analysis_worker.handle_request(*messages[0][1][0])
+
+    # assert request is acknowledged and removed
+    assert redis.xpending("test-analysis", analysis_worker.ANALYSIS_GROUP_NAME)["pending"] == 0
+    assert redis.xlen("test-analysis") == 0
+
+    # assert black takes the queen, and is better off for it
+    event = parse_game_event(decode_game_event(redis.xrevrange(stream_key_from_id(game_id), count=1)[0][1]))
+    assert event.event == EventTypes.ANALYSIS.value
+    assert (event.ply, event.depth) == (5, 2)
+    assert event.best_move == Move(src_coordinate=Coordinate(x=5, y=2), dest_coordinate=Coordinate(x=6, y=4))
+    assert event.score < -500 and event.mate is None
+
+    # cleanup
+    analysis_worker.executor.shutdown()
+    expire_game(game_id, redis, 0)
+    redis.delete("test-analysis")
+
+
+def test_handle_mated(monkeypatch):
+
+    # prepare vars
+    game_id = 2
+    monkeypatch.setattr(analysis_worker, "ANALYSIS_STREAM_NAME", "test-analysis")
+    analysis_worker.create_group()
+    init_game(game_id, redis)
+
+    # white is mated
+    write_moves(game_id, redis, FOOLS_MATE)
+
+    # request analysis and handle it
+    write_event_to_analysis_worker(game_id, redis, "test-analysis")
+    messages = redis.xreadgroup(analysis_worker.ANALYSIS_GROUP_NAME,
+                                analysis_worker.ANALYSIS_CONSUMER_NAME, {"test-analysis": ">"}, count=1)
+    analysis_worker.handle_request(*messages[0][1][0])
+
+    # assert mate is reported, rather than a bare mate score
+    event = parse_game_event(decode_game_event(redis.xrevrange(stream_key_from_id(game_id), count=1)[0][1]))
+    assert (event.score, event.mate, event.best_move) == (-analysis_worker.MATE, 0, None)
+
+    # cleanup
+    expire_game(game_id, redis, 0)
+    redis.delete("test-analysis")
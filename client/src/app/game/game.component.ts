@@ -1,6 +1,6 @@
 import { Component, OnInit } from '@angular/core';
 import { ActivatedRoute } from '@angular/router';
-import { HttpClient } from '@angular/common/http';
+import { HttpClient, HttpErrorResponse } from '@angular/common/http';
 
 import { range } from '../shared/utils'
 import { GameEvent, EventType } from '../shared/models/gameevent.model'
@@ -18,6 +18,7 @@ export class GameComponent implements OnInit {
 
   game_id: number
   turn_white: boolean = true
+  ply: number = 0
   is_white?: boolean
   chessboard = DEFAULT_CHESSBOARD
   log: string = ""
@@ -29,6 +30,9 @@ export class GameComponent implements OnInit {
   private focused_chesspiece?: Coordinate
   private focused_spots: Coordinate[] = []
   private board_locked: boolean = false
+  private legal_moves: { [src: string]: Coordinate[] } = {}
+  private legal_moves_ply?: number
+  private legal_moves_etag?: string
 
   constructor(private websocketService: WebsocketService, private route: ActivatedRoute, private http: HttpClient) {
 
@@ -50,7 +54,10 @@ export class GameComponent implements OnInit {
           if (this.init_timeout_id) {
             clearTimeout(this.init_timeout_id)
           }
-          return setTimeout(() => { this.init_complete = true }, 1000)
+          return setTimeout(() => {
+            this.init_complete = true
+            this.fetch_legal_moves()
+          }, 1000)
         }
         this.init_timeout_id = handle_init_timeout()
 
@@ -62,8 +69,14 @@ export class GameComponent implements OnInit {
             this.chessboard[e.move.src_coordinate.y][e.move.src_coordinate.x] = undefined
 
             this.turn_white = !this.turn_white
+            this.ply++
             this.board_locked = false
 
+            // moves of replayed plies are never needed
+            if (this.init_complete) {
+              this.fetch_legal_moves()
+            }
+
             // component is not rendered until init_complete is true
             // if 1s passes since the last move received - render the component
             if (!this.init_complete) {
@@ -76,12 +89,41 @@ export class GameComponent implements OnInit {
           [EventType.CHECKMATE]: (e) => {
             this.board_locked = true
             this.log = `Checkmate! ${e.white_wins ? 'White' : 'Black'} wins!`
+          },
+          [EventType.STALEMATE]: (e) => {
+            this.board_locked = true
+            this.log = "Stalemate! It's a draw."
+          },
+          [EventType.FORCED_MATE]: (e) => {
+            this.log = `${e.white_wins ? 'White' : 'Black'} can force mate in ${e.moves}!`
+          },
+          [EventType.ANALYSIS]: (e) => {
+
+            // analysis of an earlier position is of no use
+            if (e.ply != this.ply) {
+              return
+            }
+
+            const evaluation = e.mate === 0 ? `checkmate, ${e.score > 0 ? 'White' : 'Black'} wins`
+              : e.mate ? `mate in ${Math.abs(e.mate)} for ${e.mate > 0 ? 'White' : 'Black'}`
+              : `${e.score > 0 ? '+' : ''}${(e.score / 100).toFixed(2)}`
+            const best_move = e.best_move
+              ? `, best move ${e.best_move.src_coordinate.x},${e.best_move.src_coordinate.y} to ${e.best_move.dest_coordinate.x},${e.best_move.dest_coordinate.y}`
+              : ''
+            this.log = `Analysis (depth ${e.depth}): ${evaluation}${best_move}`
           }
         }
 
         // subscribe to game moves and handle each move
         this.websocketService.get_events$().subscribe({
-          next: (e) => { this.log = ""; event_resolver[e.event](e) },
+          next: (e) => {
+
+            // analysis leaves the log alone unless it is of the current position
+            if (e.event != EventType.ANALYSIS) {
+              this.log = ""
+            }
+            event_resolver[e.event](e)
+          },
           complete: () => {
             this.connection_log = "game ended"
           }
@@ -148,19 +190,49 @@ export class GameComponent implements OnInit {
 
   focus(c: Coordinate): void {
 
-    this.board_locked = true
     this.unfocus()
 
-    // get all move suggestions and focus on them
+    // focus on legal moves of the piece, fetched once per ply
     this.focused_chesspiece = c
-    this.http.post<Coordinate[]>(`${ENV.GATEWAY_HTTP_ENDPOINT}/game/${this.game_id}/suggest`, c).subscribe({
-      next: (suggestions) => {
-        this.focused_spots = suggestions
-      },
-      complete: () => {
-        this.board_locked = false
-      }
-    })
+    if (this.legal_moves_ply === this.ply) {
+      this.focused_spots = this.legal_moves[`${c.x},${c.y}`] ?? []
+    }
+
+  }
+
+  fetch_legal_moves(): void {
+
+    // moves are only needed on user's turn
+    if (this.is_white != this.turn_white) {
+      return
+    }
+
+    // gateway answers 304 if moves of the current ply were already fetched
+    const ply = this.ply
+    const headers: { [header: string]: string } = this.legal_moves_etag ? { "If-None-Match": this.legal_moves_etag } : {}
+    this.http.get<{ [src: string]: Coordinate[] }>(`${ENV.GATEWAY_HTTP_ENDPOINT}/game/${this.game_id}/legal_moves`,
+      { headers, observe: 'response' }).subscribe({
+        next: (response) => {
+
+          // moves of an earlier ply are of no use
+          if (ply != this.ply) {
+            return
+          }
+
+          this.legal_moves = response.body ?? {}
+          this.legal_moves_ply = ply
+          this.legal_moves_etag = response.headers.get("ETag") ?? undefined
+        },
+        error: (e: HttpErrorResponse) => {
+
+          // moves already held are still those of the current ply
+          if (e.status == 304 && ply == this.ply) {
+            this.legal_moves_ply = ply
+          } else if (e.status != 304) {
+            this.log = "Could not fetch legal moves."
+          }
+        }
+      })
 
   }
 
@@ -173,6 +245,12 @@ export class GameComponent implements OnInit {
 
   }
 
+  analyze(): void {
+
+    // result arrives as a game event
+    this.http.post(`${ENV.GATEWAY_HTTP_ENDPOINT}/game/${this.game_id}/analyze`, null).subscribe()
+  }
+
   perform_move(src: Coordinate, dest: Coordinate): void {
 
     // unfocus piece
@@ -3,11 +3,20 @@ import { Move } from './move.model'
 export enum EventType {
     MOVE = "move",
     CHECK = "check",
-    CHECKMATE = "checkmate"
+    CHECKMATE = "checkmate",
+    STALEMATE = "stalemate",
+    FORCED_MATE = "forced_mate",
+    ANALYSIS = "analysis"
 }
 
 export interface GameEvent {
     event: EventType
     move: Move
     white_wins: boolean
+    moves: number
+    ply: number
+    depth: number
+    score: number
+    mate?: number
+    best_move?: Move
 }
\ No newline at end of file
@@ -5,59 +5,325 @@ Endgame validator receives message from move validator after a move
 has been performed and checks if the game has ended. In case
 the game has indeed ended, game is marked as finished by
 setting expiration time on the game key within redis.
+Optionally, games which go on are searched for a mate the side to move
+can force within a few moves, bounded by the amount of searched positions.
+
+Any amount of endgame validators may run side by side. Endgame stream
+is split into shards, each shard is leased to a single endgame validator
+at a time so events of a game are handled in order. Shards are spread
+evenly across live endgame validators, and messages left unacknowledged
+by a crashed endgame validator are reclaimed by the next owner of its shards.
+
+Messages are read in batches. Only the latest position of a game matters,
+so all messages of a game within a batch are handled by a single check.
+Games of a batch are checked concurrently by a pool of worker processes.
+
+When games are spread across multiple redis nodes, each node holds its own
+endgame stream, and endgame validators serve the single node of REDIS_HOST.
+Positions are still cached on the first node of REDIS_HOSTS, which holds
+data shared by all games, so every service reads the same cache.
+
+Metrics are served in prometheus text format on a side port, including
+the ones recorded by worker processes.
 """
 
 import os
+import math
+import time
+import shutil
+import atexit
+import tempfile
+import socket
 import logging
-from redis import Redis
-from chess_utils import ChessBoard, CheckmateGameEvent, stream_key_from_id, game_exists, write_event_to_game, expire_game
+from typing import List, Set, Dict, Tuple, Optional
+from concurrent.futures import ProcessPoolExecutor
+
+# when run as a service, worker processes record metrics to files of a directory shared
+# with the main process. set before prometheus_client is imported, which picks its
+# storage on import, so importing the module elsewhere leaves metrics as they are
+if __name__ == "__main__" and "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="endgame_validator-")
+    atexit.register(shutil.rmtree, os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+
+from redis import Redis, ConnectionPool, ResponseError
+from prometheus_client import start_http_server
+from chess_utils import ChessBoard, GameEvent, FINAL_GAME_EVENTS, stream_key_from_id, game_exists, write_event_to_game, expire_game, position_cache_from_env, \
+    redis_router_from_env, endgame_stream_key, RoundTripConnection, count_redis_round_trips, metrics_registry, ENDGAME_QUEUE_DEPTH, ENDGAME_LAG_SECONDS, \
+    FIND_CHECKS_SECONDS
 
 logging.basicConfig(level=logging.DEBUG)
-redis = Redis(host=os.getenv("REDIS_HOST", "localhost"),
-              port=int(os.getenv("REDIS_PORT", "6379")),
-              db=0,
-              decode_responses=True)
+redis = Redis(connection_pool=ConnectionPool(host=os.getenv("REDIS_HOST", "localhost"),
+                                             port=int(os.getenv("REDIS_PORT", "6379")),
+                                             db=0,
+                                             decode_responses=True,
+                                             connection_class=RoundTripConnection))
+position_cache = position_cache_from_env(redis_router_from_env().nodes[0])
 
 ENDGAME_STREAM_NAME = os.getenv("ENDGAME_STREAM_NAME", "endgame")
+ENDGAME_SHARDS = int(os.getenv("ENDGAME_SHARDS", "1"))
+ENDGAME_GROUP_NAME = os.getenv("ENDGAME_GROUP_NAME", "endgame_validator")
+ENDGAME_CONSUMER_NAME = os.getenv(
+    "ENDGAME_CONSUMER_NAME", f"{socket.gethostname()}-{os.getpid()}")
+ENDGAME_LEASE_TIMEOUT = int(os.getenv("ENDGAME_LEASE_TIMEOUT", "10000"))
+MOVE_LEDGER = os.getenv("MOVE_LEDGER", "false") == "true"
+ENDGAME_BATCH_SIZE = int(os.getenv("ENDGAME_BATCH_SIZE", "100"))
+ENDGAME_WORKERS = int(os.getenv("ENDGAME_WORKERS", str(os.cpu_count() or 1)))
+ENDGAME_METRICS_PORT = int(os.getenv("ENDGAME_METRICS_PORT", "8002"))
+ENDGAME_MATE_MOVES = int(os.getenv("ENDGAME_MATE_MOVES", "0"))
+ENDGAME_MATE_NODES = int(os.getenv("ENDGAME_MATE_NODES", "10000"))
 
+# pool of worker processes, started once a batch holds multiple games
+executor: Optional[ProcessPoolExecutor] = None
 
-def main():
+# renews or releases shard lease, as long as it is still held by given consumer
+RENEW_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
 
-    logging.info("awaiting notifications from move validator")
+
+def shard_streams() -> List[str]:
+    return [endgame_stream_key(ENDGAME_STREAM_NAME, shard) for shard in range(0, ENDGAME_SHARDS)]
+
+
+def lease_key(stream: str) -> str:
+    return f"{stream}-lease"
+
+
+def create_groups():
+    """Creates consumer group on each shard, unless it already exists."""
+
+    for stream in shard_streams():
+        try:
+            redis.xgroup_create(stream, ENDGAME_GROUP_NAME,
+                                id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+
+def balance_shards(owned: Set[str]) -> Set[str]:
+    """
+    Renews leases of owned shards, then acquires or releases shards so
+    that each live endgame validator owns an even share of them.
+    Returns newly acquired shards.
+    """
+
+    # announce self and count live endgame validators
+    now = int(time.time() * 1000)
+    consumers_key = f"{ENDGAME_STREAM_NAME}-consumers"
+    pipeline = redis.pipeline()
+    pipeline.zadd(consumers_key, {ENDGAME_CONSUMER_NAME: now})
+    pipeline.zremrangebyscore(consumers_key, 0, now - ENDGAME_LEASE_TIMEOUT)
+    pipeline.zcard(consumers_key)
+    share = math.ceil(ENDGAME_SHARDS / pipeline.execute()[-1])
+
+    # forget shards which were taken over in the meantime
+    renew_lease = redis.register_script(RENEW_LEASE_SCRIPT)
+    for stream in list(owned):
+        if not renew_lease(keys=[lease_key(stream)], args=[ENDGAME_CONSUMER_NAME, ENDGAME_LEASE_TIMEOUT]):
+            logging.warning(f"lost lease of {stream}")
+            owned.discard(stream)
+
+    # hand over shards above the share
+    release_lease = redis.register_script(RELEASE_LEASE_SCRIPT)
+    while len(owned) > share:
+        stream = owned.pop()
+        release_lease(keys=[lease_key(stream)], args=[ENDGAME_CONSUMER_NAME])
+        logging.info(f"released lease of {stream}")
+
+    # take over free shards up to the share
+    acquired = set()
+    for stream in shard_streams():
+
+        if len(owned) >= share:
+            break
+
+        if stream not in owned and redis.set(lease_key(stream), ENDGAME_CONSUMER_NAME,
+                                             nx=True, px=ENDGAME_LEASE_TIMEOUT):
+            logging.info(f"acquired lease of {stream}")
+            owned.add(stream)
+            acquired.add(stream)
+
+    return acquired
+
+
+def _check_game(game_id: int) -> Tuple[bool, List[GameEvent], Optional[float]]:
+    """
+    Checks game as check_game() does, along with the time the search for
+    checks took. Time is left for the main process to record, since
+    metrics recorded by worker processes are lost.
+    """
+
+    if not game_exists(game_id, redis):
+        return False, [], None
+
+    # get board of current game
+    board = ChessBoard.from_redis(game_id, redis, cache=position_cache, ledger=MOVE_LEDGER)
+    start = time.perf_counter()
+    event = board.find_checks()
+    seconds = time.perf_counter() - start
+    events = [event] if event else []
+
+    if ENDGAME_MATE_MOVES and not isinstance(event, FINAL_GAME_EVENTS):
+        mate = board.find_forced_mate(ENDGAME_MATE_MOVES, ENDGAME_MATE_NODES)
+        if mate:
+            events.append(mate)
+
+    return True, events, seconds
+
+
+def _record_check(result: Tuple[bool, List[GameEvent], Optional[float]]) -> Tuple[bool, List[GameEvent]]:
+
+    exists, events, seconds = result
+    if seconds is not None:
+        FIND_CHECKS_SECONDS.observe(seconds)
+
+    return exists, events
+
+
+def check_game(game_id: int) -> Tuple[bool, List[GameEvent]]:
+    """
+    Checks latest position of a game for check / checkmate / stalemate,
+    then for a forced mate if the game goes on and mate search is enabled.
+    Returns whether the game exists along with the found events.
+    """
+
+    return _record_check(_check_game(game_id))
+
+
+def check_games(game_ids: List[int]) -> List[Tuple[bool, List[GameEvent]]]:
+    """Checks games concurrently, unless there is only one."""
+
+    global executor
+
+    if len(game_ids) < 2 or ENDGAME_WORKERS < 2:
+        return [check_game(game_id) for game_id in game_ids]
+
+    if executor is None:
+        executor = ProcessPoolExecutor(ENDGAME_WORKERS)
+
+    return [_record_check(result) for result in executor.map(_check_game, game_ids)]
+
+
+def handle_messages(messages: Dict[str, List[Tuple[str, Optional[dict]]]]):
+    """
+    Handles batch of messages read from shards. Messages of the same game
+    are collapsed into a single check of the game's latest position.
+    """
+
+    # unique game ids in order of arrival. fields are missing if
+    # message was deleted before being acknowledged
+    game_ids = list(dict.fromkeys(
+        int(fields["game_id"]) for entries in messages.values() for _, fields in entries if fields))
+
+    logging.info("received notifications for end validation for games %s", game_ids)
+
+    # stream ids start off the time messages were added at, in milliseconds
+    now = time.time()
+    for entries in messages.values():
+        for message_ts, _ in entries:
+            ENDGAME_LAG_SECONDS.observe(
+                max(0, now - int(message_ts.split("-")[0]) / 1000))
+
+    for game_id, (exists, events) in zip(game_ids, check_games(game_ids)):
+
+        if not exists:
+            logging.warning("received message for non-existing game (id %s)", game_id)
+
+        # if check, end of game or forced mate detected
+        for event in events:
+
+            # if game is over - mark game as finished
+            if isinstance(event, FINAL_GAME_EVENTS):
+                expire_game(game_id, redis, 60)
+
+            # write event to game
+            write_event_to_game(game_id, redis, event)
+
+            logging.info("game id %s: new event: %s", game_id, event)
+
+    # acknowledge and remove all handled messages at once
+    pipeline = redis.pipeline()
+    for stream, entries in messages.items():
+        if entries:
+            message_ts = [ts for ts, _ in entries]
+            pipeline.xack(stream, ENDGAME_GROUP_NAME, *message_ts)
+            pipeline.xdel(stream, *message_ts)
+    pipeline.execute()
+
+
+def reclaim(stream: str):
+    """
+    Handles messages left unacknowledged on a shard by its previous owner.
+    Shard is leased exclusively, so every pending message is up for grabs.
+    """
+
+    start = "0-0"
 
     while True:
 
-        # read single endgame message
-        move = redis.xread({ENDGAME_STREAM_NAME: 0}, count=1, block=0)
-        message_ts = move[0][1][0][0]
-        game_id = int(move[0][1][0][1]["game_id"])
+        start, messages = redis.xautoclaim(stream, ENDGAME_GROUP_NAME, ENDGAME_CONSUMER_NAME,
+                                           min_idle_time=0, start_id=start, count=ENDGAME_BATCH_SIZE)[:2]
+        handle_messages({stream: messages})
+
+        if start == "0-0":
+            break
 
-        logging.info(
-            f"received notification for end validation for game {game_id}")
 
-        if not game_exists(game_id, redis):
-            logging.warn(
-                f"received message for non-existing game (id {game_id})")
+def report_queue_depth(owned: Set[str]):
+    """Reports amount of messages waiting on each owned shard, shards owned by others report none."""
 
-        else:
+    streams = sorted(owned)
+    pipeline = redis.pipeline(transaction=False)
+    for stream in streams:
+        pipeline.xlen(stream)
+    depths = dict(zip(streams, pipeline.execute()))
 
-            # get board of current game
-            event = ChessBoard.from_redis(game_id, redis).find_checks()
+    # shards are zeroed rather than removed, since values recorded to files outlive removal
+    for stream in shard_streams():
+        ENDGAME_QUEUE_DEPTH.labels(stream).set(depths.get(stream, 0))
 
-            # if check detected
-            if event:
 
-                # if checkmate - mark game as finished
-                if isinstance(event, CheckmateGameEvent):
-                    expire_game(game_id, redis, 60)
+def main():
+
+    logging.info("awaiting notifications from move validator")
+
+    if ENDGAME_METRICS_PORT:
+        start_http_server(ENDGAME_METRICS_PORT, registry=metrics_registry())
+
+    create_groups()
+    owned: Set[str] = set()
+    balanced_at = 0
+
+    while True:
+
+        # renew leases well before they expire
+        if time.monotonic() - balanced_at > ENDGAME_LEASE_TIMEOUT / 3000:
+            for stream in balance_shards(owned):
+                reclaim(stream)
+            report_queue_depth(owned)
+            balanced_at = time.monotonic()
 
-                # write event to game
-                write_event_to_game(game_id, redis, event)
+        if not owned:
+            time.sleep(ENDGAME_LEASE_TIMEOUT / 3000)
+            continue
 
-                # remove handled move from stream and add move to game
-                logging.info(f"game id {game_id}: new event: {event}")
+        # read batch of endgame messages of owned shards
+        messages = redis.xreadgroup(ENDGAME_GROUP_NAME, ENDGAME_CONSUMER_NAME,
+                                    {stream: ">" for stream in owned}, count=ENDGAME_BATCH_SIZE, block=1000)
 
-        redis.xdel(ENDGAME_STREAM_NAME, message_ts)
+        if messages:
+            with count_redis_round_trips("handle_messages"):
+                handle_messages(dict(messages))
 
 
 if __name__ == "__main__":
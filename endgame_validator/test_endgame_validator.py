@@ -1,10 +1,13 @@
 #!/usr/bin/env python3.8
 
-import json
+from typing import Set
 from multiprocessing import Process
+import endgame_validator
 from endgame_validator import redis as app_redis, main as app_main
 from redis import Redis
-from chess_utils import write_event_to_game, stream_key_from_id, MoveGameEvent, Move, Coordinate, EventTypes, write_event_to_endgame_validator
+from chess_utils import stream_key_from_id, EventTypes, write_event_to_endgame_validator, \
+    endgame_stream_key, init_game, expire_game, decode_game_event, ForcedMateGameEvent, metrics_registry
+from chess_fixtures import FOOLS_MATE, BISHOP_CHECK, write_moves
 
 redis: Redis = app_redis
 
@@ -13,35 +16,137 @@ def test_checkmate():
 
     # prepare vars
     game_id = 1
-    ts = 0
 
     # run endgame validator in a separate process
     app_process = Process(target=app_main)
     app_process.start()
 
     # set-up a checkmate
-    for c in [
-        (Coordinate(x=5, y=6), Coordinate(x=5, y=5)),
-        (Coordinate(x=4, y=1), Coordinate(x=4, y=3)),
-        (Coordinate(x=6, y=6), Coordinate(x=6, y=4)),
-        (Coordinate(x=3, y=0), Coordinate(x=7, y=4)),
-    ]:
-        # write event to game and read it back
-        write_event_to_game(game_id, redis, MoveGameEvent(move=Move(
-            src_coordinate=c[0],
-            dest_coordinate=c[1]
-        )))
-        write_event_to_endgame_validator(game_id, redis, "endgame")
-        event = redis.xread(
-            {stream_key_from_id(game_id): ts}, count=1, block=0)
-        ts = event[0][1][0][0]
+    write_moves(game_id, redis, FOOLS_MATE, "endgame")
+    ts = [ts for ts, fields in redis.xrange(stream_key_from_id(game_id))
+          if decode_game_event(fields)["event"] == EventTypes.MOVE.value][-1]
 
     # read additional event and assert that it's a checkmate event
     event = redis.xread({stream_key_from_id(game_id): ts}, count=1, block=5000)
     try:
-        assert json.loads(event[0][1][0][1]["data"])[
+        assert decode_game_event(event[0][1][0][1])[
             "event"] == EventTypes.CHECKMATE.value
     except KeyError:
         assert False
 
     app_process.terminate()
+
+
+def test_balance_shards(monkeypatch):
+
+    # prepare vars
+    monkeypatch.setattr(endgame_validator, "ENDGAME_STREAM_NAME", "test-endgame")
+    monkeypatch.setattr(endgame_validator, "ENDGAME_SHARDS", 4)
+    owned = {"a": set(), "b": set()}
+
+    def _balance(consumer: str) -> Set[str]:
+        monkeypatch.setattr(endgame_validator, "ENDGAME_CONSUMER_NAME", consumer)
+        return endgame_validator.balance_shards(owned[consumer])
+
+    # assert single endgame validator takes all shards
+    assert len(_balance("a")) == 4
+
+    # assert shards are handed over to new endgame validator
+    assert len(_balance("b")) == 0
+    assert len(_balance("a")) == 0 and len(owned["a"]) == 2
+    assert len(_balance("b")) == 2
+    assert owned["a"].isdisjoint(owned["b"])
+
+    # cleanup
+    redis.delete("test-endgame-consumers",
+                 *[endgame_validator.lease_key(s) for s in endgame_validator.shard_streams()])
+
+
+def test_reclaim(monkeypatch):
+
+    # prepare vars
+    game_id = 2
+    stream = endgame_stream_key("test-endgame", 0)
+    monkeypatch.setattr(endgame_validator, "ENDGAME_STREAM_NAME", "test-endgame")
+    init_game(game_id, redis)
+    endgame_validator.create_groups()
+
+    # set-up a check
+    write_moves(game_id, redis, BISHOP_CHECK)
+
+    # crashed endgame validator receives the message but never acknowledges it
+    write_event_to_endgame_validator(game_id, redis, "test-endgame")
+    redis.xreadgroup(endgame_validator.ENDGAME_GROUP_NAME,
+                     "crashed", {stream: ">"}, count=1)
+
+    # assert message is handled by the next owner of the shard
+    endgame_validator.reclaim(stream)
+    assert redis.xpending(stream, endgame_validator.ENDGAME_GROUP_NAME)["pending"] == 0
+    event = redis.xrevrange(stream_key_from_id(game_id), count=1)[0][1]
+    assert decode_game_event(event)["event"] == EventTypes.CHECK.value
+
+    # cleanup
+    expire_game(game_id, redis, 0)
+    redis.delete(stream)
+
+
+def test_batch(monkeypatch):
+
+    # prepare vars
+    game_ids = [3, 4]
+    stream = endgame_stream_key("test-endgame", 0)
+    monkeypatch.setattr(endgame_validator, "ENDGAME_STREAM_NAME", "test-endgame")
+    monkeypatch.setattr(endgame_validator, "ENDGAME_WORKERS", 2)
+    endgame_validator.create_groups()
+
+    # set-up a check in both games, notifying on every move
+    for game_id in game_ids:
+        init_game(game_id, redis)
+        write_moves(game_id, redis, BISHOP_CHECK, "test-endgame")
+
+    # handle all notifications as a single batch
+    messages = redis.xreadgroup(endgame_validator.ENDGAME_GROUP_NAME,
+                                endgame_validator.ENDGAME_CONSUMER_NAME, {stream: ">"}, count=100)
+    assert len(messages[0][1]) == 8
+    checks = metrics_registry().get_sample_value("chess_find_checks_seconds_count") or 0
+    endgame_validator.handle_messages(dict(messages))
+
+    # assert checks made by worker processes are reported by the main process
+    assert metrics_registry().get_sample_value("chess_find_checks_seconds_count") == checks + 2
+
+    # assert whole batch is acknowledged and removed
+    assert redis.xpending(stream, endgame_validator.ENDGAME_GROUP_NAME)["pending"] == 0
+    assert redis.xlen(stream) == 0
+
+    # assert each game is checked once
+    for game_id in game_ids:
+        events = redis.xrange(stream_key_from_id(game_id))
+        assert [decode_game_event(e[1])["event"] for e in events].count(EventTypes.CHECK.value) == 1
+
+    # cleanup
+    endgame_validator.executor.shutdown()
+    for game_id in game_ids:
+        expire_game(game_id, redis, 0)
+    redis.delete(stream)
+
+
+def test_forced_mate(monkeypatch):
+
+    # prepare vars
+    game_id = 5
+    init_game(game_id, redis)
+
+    # black is one move away from mate
+    write_moves(game_id, redis, FOOLS_MATE[:-1])
+
+    # assert mate search is off by default
+    assert endgame_validator.check_game(game_id) == (True, [])
+
+    # assert forced mate is found within budget
+    monkeypatch.setattr(endgame_validator, "ENDGAME_MATE_MOVES", 2)
+    assert endgame_validator.check_game(game_id) == (True, [ForcedMateGameEvent(white_wins=False, moves=1)])
+    monkeypatch.setattr(endgame_validator, "ENDGAME_MATE_NODES", 5)
+    assert endgame_validator.check_game(game_id) == (True, [])
+
+    # cleanup
+    expire_game(game_id, redis, 0)
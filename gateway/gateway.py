@@ -8,15 +8,19 @@ move validator microservice.
 
 import os
 import asyncio
-import requests
+import itertools
+import httpx
 import logging
 import json
-from requests.exceptions import RequestException
-from chess_utils import Move, Coordinate, ChessBoard, stream_key_from_id, game_exists, init_game
-from redis import Redis
+from typing import Optional, List, Dict, Set
+from chess_utils import Move, Coordinate, ChessBoard, stream_key_from_id, game_exists, init_game, square_from_coordinate, coordinate_from_square, position_cache_from_env, \
+    legal_moves_key_from_id, last_game_ts, save_game_hash, decode_game_event, write_event_to_analysis_worker, RedisRouter, redis_router_from_env, \
+    AsyncRoundTripConnection, RoundTripMiddleware, generate_metrics, WEBSOCKET_FANOUT, VALID_MOVES_SECONDS
+from prometheus_client import CONTENT_TYPE_LATEST
+from redis.asyncio import Redis as AsyncRedis, ConnectionPool as AsyncConnectionPool, BlockingConnectionPool
 from fastapi import FastAPI, WebSocket, Response
-from starlette.websockets import WebSocketState, WebSocketDisconnect
-from fastapi import Body, status
+from starlette.websockets import WebSocketDisconnect
+from fastapi import Body, Header, Query, status
 from fastapi.logger import logger as fastapi_logger
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -25,10 +29,41 @@ logger = logging.getLogger('gunicorn.error')
 fastapi_logger.handlers = logger.handlers
 fastapi_logger.setLevel(logging.DEBUG)
 
-redis = Redis(host=os.getenv("REDIS_HOST", "localhost"),
-              port=int(os.getenv("REDIS_PORT", "6379")),
-              db=0,
-              decode_responses=True)
+# games are spread across redis nodes, first node also holds data shared by all games
+redis_router = redis_router_from_env()
+redis = redis_router.nodes[0]
+position_cache = position_cache_from_env(redis)
+
+# async redis is used by websockets, so waiting on game streams does not block
+# the event loop. blocking pool makes sockets wait for a free connection
+# instead of failing once max connections are reached
+async_redis_router = redis_router_from_env(AsyncRedis, BlockingConnectionPool, AsyncRoundTripConnection,
+                                           max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", "1000")),
+                                           timeout=None)
+
+# game stream readers block on redis for seconds at a time, holding a connection
+# per active game. they get a pool of their own, so requests are never starved by them
+stream_redis_router = redis_router_from_env(AsyncRedis, AsyncConnectionPool, AsyncRoundTripConnection)
+
+# move validator replicas, tried in turn on connection errors
+MOVE_VALIDATOR_ENDPOINTS = os.getenv(
+    "MOVE_VALIDATOR_ENDPOINT", "http://localhost:8001").split(",")
+MOVE_VALIDATOR_ATTEMPTS = int(os.getenv("MOVE_VALIDATOR_ATTEMPTS", "3"))
+MOVE_VALIDATOR_TIMEOUT = float(os.getenv("MOVE_VALIDATOR_TIMEOUT", "10"))
+
+# long lived client keeps connections to move validators alive between moves
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=int(
+            os.getenv("MOVE_VALIDATOR_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(
+            os.getenv("MOVE_VALIDATOR_MAX_CONNECTIONS", "100"))
+    ),
+    timeout=MOVE_VALIDATOR_TIMEOUT)
+move_validator_turn = itertools.count()
+
+ANALYSIS_STREAM_NAME = os.getenv("ANALYSIS_STREAM_NAME", "analysis")
+
 app = FastAPI()
 
 app.add_middleware(
@@ -42,66 +77,228 @@ app.add_middleware(
         "http://127.0.0.1"
     ],
     allow_methods=["*"],
-    allow_headers=["*"]
+    allow_headers=["*"],
+    expose_headers=["ETag"]
 )
+app.add_middleware(RoundTripMiddleware)
 
 
-async def transmit_game(websocket: WebSocket, game_id: int):
+class GameBroadcaster:
 
-    class GameEndedException(Exception):
-        pass
+    """
+    Reads each active game stream once and fans its events out to all
+    of the game's websockets. Each subscriber gets the events read so far
+    as a backlog, followed by batches of new events on a bounded queue.
+    Subscribers which fall behind by more than queue_size batches are
+    dropped instead of stalling the rest.
+    """
+
+    class Subscriber:
+
+        def __init__(self, backlog: List[dict], queue_size: int) -> None:
+            self.backlog = backlog
+            self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+            self.dropped = False
+
+    class Game:
+
+        def __init__(self) -> None:
+            self.events: List[dict] = []
+            self.subscribers: Set['GameBroadcaster.Subscriber'] = set()
+            self.reader: Optional[asyncio.Task] = None
+
+    def __init__(self, router: RedisRouter[AsyncRedis], queue_size: int = 16) -> None:
+        self.router = router
+        self.queue_size = queue_size
+        self._games: Dict[int, GameBroadcaster.Game] = {}
+
+    def subscribe(self, game_id: int) -> 'GameBroadcaster.Subscriber':
+
+        # start reading game stream if nobody is listening yet
+        game = self._games.get(game_id)
+        if game is None:
+            game = self._games[game_id] = self.Game()
+            game.reader = asyncio.create_task(self._read(game_id, game))
+
+        subscriber = self.Subscriber(list(game.events), self.queue_size)
+        game.subscribers.add(subscriber)
+
+        return subscriber
+
+    def unsubscribe(self, game_id: int, subscriber: 'GameBroadcaster.Subscriber'):
+
+        # reader stops on its own once there are no subscribers left
+        game = self._games.get(game_id)
+        if game:
+            game.subscribers.discard(subscriber)
+
+    def _close(self, subscriber: 'GameBroadcaster.Subscriber', drop: bool):
+
+        """Closes subscriber by sending None. Slow subscribers lose pending events."""
+
+        if drop or subscriber.queue.full():
+            subscriber.dropped = True
+            while not subscriber.queue.empty():
+                subscriber.queue.get_nowait()
+
+        subscriber.queue.put_nowait(None)
+
+    async def _read(self, game_id: int, game: 'GameBroadcaster.Game'):
+
+        ts = 0
+        stream_key = stream_key_from_id(game_id)
+        redis = self.router.get(game_id)
+
+        try:
+
+            while game.subscribers:
+
+                moves = await redis.xread({stream_key: ts}, count=100, block=5000)
 
-    async def _update_websocket_state(websocket: WebSocket) -> bool:
+                # game stream is gone - game has ended
+                if not moves:
+                    if not await redis.exists(stream_key):
+                        break
+                    continue
+
+                # parse stream messages once for all subscribers
+                ts = moves[0][1][-1][0]
+                events = [decode_game_event(fields)
+                          for _, fields in moves[0][1]]
+                game.events.extend(events)
+
+                logger.info("sending %s events for game id %s to %s websockets",
+                            len(events), game_id, len(game.subscribers))
+                WEBSOCKET_FANOUT.observe(len(game.subscribers))
+
+                for subscriber in list(game.subscribers):
+                    try:
+                        subscriber.queue.put_nowait(events)
+                    except asyncio.QueueFull:
+                        logger.warning(
+                            f"dropping slow websocket of game id {game_id}")
+                        game.subscribers.discard(subscriber)
+                        self._close(subscriber, True)
+
+        except Exception as e:
+            logger.warning(
+                f"an error occurred while reading game id {game_id}: {e}")
+
+        finally:
+
+            del self._games[game_id]
+            for subscriber in game.subscribers:
+                self._close(subscriber, False)
+
+
+broadcaster = GameBroadcaster(stream_redis_router,
+                              int(os.getenv("WEBSOCKET_QUEUE_SIZE", "16")))
+
+
+async def transmit_game(websocket: WebSocket, game_id: int):
+
+    async def _wait_for_disconnect():
 
         """
-        Websocket state is not automatically updated because reasons.
-        This function simulates a check which triggers websocket state change.
+        Websocket state is only updated when receiving messages.
+        Client is not expected to send anything, so receive until disconnect.
         """
 
         try:
-            await asyncio.wait_for(
-                websocket.receive_text(), 0.001
-            )
-        except asyncio.TimeoutError:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
             pass
 
     # accept connection
     await websocket.accept()
-    await asyncio.sleep(0)
-
-    ts = 0
-    stream_key = stream_key_from_id(game_id)
+    disconnect = asyncio.create_task(_wait_for_disconnect())
+    subscriber = broadcaster.subscribe(game_id)
 
     try:
 
-        # listen on stream and send new moves to client
+        # send moves performed so far
+        for event in subscriber.backlog:
+            await websocket.send_json(event)
+
+        # send new moves to client
         while True:
 
-            # read move and timestamp
-            move = redis.xread({stream_key: ts}, count=1, block=5000)
+            events = asyncio.create_task(subscriber.queue.get())
+            await asyncio.wait({events, disconnect}, return_when=asyncio.FIRST_COMPLETED)
 
-            # check websocket state
-            await _update_websocket_state(websocket)
-            if websocket.client_state != WebSocketState.CONNECTED:
-                raise WebSocketDisconnect
+            if disconnect.done():
+                events.cancel()
+                break
 
-            if not game_exists(game_id, redis):
-                raise GameEndedException
+            # game has ended or client is too slow
+            if events.result() is None:
+                if subscriber.dropped:
+                    await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                break
 
-            if move:
+            for event in events.result():
+                await websocket.send_json(event)
 
-                # parse stream message
-                ts = move[0][1][0][0]
-                move_data = json.loads(move[0][1][0][1]["data"])
+    except WebSocketDisconnect:
+        pass
 
-                # send move
-                logger.info(
-                    f"[{websocket.client.host}:{websocket.client.port}] sending move for game id {game_id}: {move_data}")
-                await websocket.send_json(move_data)
-                await asyncio.sleep(0)
+    finally:
+        broadcaster.unsubscribe(game_id, subscriber)
+        disconnect.cancel()
 
-    except (WebSocketDisconnect, GameEndedException):
-        pass
+
+@app.on_event("startup")
+async def reset_async_redis():
+
+    # pooled connections are bound to the event loop which opened them,
+    # so every loop serving the app starts off an empty pool
+    for async_redis in async_redis_router.nodes + stream_redis_router.nodes:
+        async_redis.connection_pool.reset()
+
+
+@app.on_event("shutdown")
+async def close_async_redis():
+    for async_redis in async_redis_router.nodes + stream_redis_router.nodes:
+        await async_redis.close()
+        await async_redis.connection_pool.disconnect()
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
+
+
+async def post_to_move_validator(game_id: int, move: Move) -> httpx.Response:
+    """
+    Posts move to move validator replicas in turn, all attempts share
+    a single deadline. Only connection errors are retried, as the
+    move was never received by the move validator.
+    """
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + MOVE_VALIDATOR_TIMEOUT
+    turn = next(move_validator_turn)
+
+    for attempt in range(0, MOVE_VALIDATOR_ATTEMPTS):
+
+        endpoint = MOVE_VALIDATOR_ENDPOINTS[(
+            turn + attempt) % len(MOVE_VALIDATOR_ENDPOINTS)]
+
+        try:
+            return await http_client.post(f"{endpoint}/validate",
+                                          content=move.json(),
+                                          params={"game_id": game_id},
+                                          timeout=max(deadline - loop.time(), 0))
+
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+
+            # out of attempts or time
+            if attempt == MOVE_VALIDATOR_ATTEMPTS - 1 or loop.time() >= deadline:
+                raise
+
+            logger.warning(
+                f"could not connect to move validator at {endpoint}, retrying: {e}")
 
 
 @app.post("/game/{game_id}/create", status_code=status.HTTP_201_CREATED)
@@ -110,6 +307,9 @@ def create_game(game_id: int):
     Creates a new redis stream for given game id.
     """
 
+    # redis node holding the game
+    redis = redis_router.get(game_id)
+
     # make sure no duplicate game
     if game_exists(game_id, redis):
         return Response(status_code=status.HTTP_400_BAD_REQUEST,
@@ -125,7 +325,7 @@ async def join_game(websocket: WebSocket, game_id: int):
     """Simply sends game moves to client via websocket."""
 
     # make sure game exists
-    if not game_exists(game_id, redis):
+    if not await async_redis_router.get(game_id).exists(stream_key_from_id(game_id)):
         return Response(status_code=status.WS_1008_POLICY_VIOLATION)
 
     # transmit moves
@@ -133,30 +333,28 @@ async def join_game(websocket: WebSocket, game_id: int):
 
 
 @app.post("/game/{game_id}/move", status_code=status.HTTP_201_CREATED)
-def perform_move(game_id: int, move: Move = Body()):
+async def perform_move(game_id: int, move: Move = Body()):
     """Performs move by delegating to move validator."""
 
     # make sure game exists
-    if not game_exists(game_id, redis):
+    if not await async_redis_router.get(game_id).exists(stream_key_from_id(game_id)):
         return Response(status_code=status.HTTP_400_BAD_REQUEST,
                         content=f"Game with ID {game_id} does not exist.")
 
     try:
 
+        # lazy formatting, model is only dumped if logged
         logger.info(
-            f"delegating game id {game_id} move validation for the following move: {move.dict()}")
+            "delegating game id %s move validation for the following move: %s", game_id, move)
 
         # post move to move validator
-        response = requests.post(f'{os.getenv("MOVE_VALIDATOR_ENDPOINT", "http://localhost:8001")}/validate',
-                                 data=move.json(),
-                                 params={"game_id": game_id},
-                                 timeout=10)
+        response = await post_to_move_validator(game_id, move)
 
         # raise exception on server-side errors
         if response.status_code >= 500:
             response.raise_for_status()
 
-    except RequestException as e:
+    except httpx.HTTPError as e:
         logger.warn(
             f"an error occurred while validating move for game id {game_id}: {e}")
         return Response(status_code=status.HTTP_502_BAD_GATEWAY,
@@ -167,22 +365,129 @@ def perform_move(game_id: int, move: Move = Body()):
         return Response(status_code=status.HTTP_400_BAD_REQUEST,
                         content=f"Invalid move.")
 
+    # 409 from move validator - another move was performed meanwhile
+    if response.status_code == 409:
+        return Response(status_code=status.HTTP_409_CONFLICT,
+                        content="Game has changed, move was not performed.")
+
 
 @app.post("/game/{game_id}/suggest", status_code=status.HTTP_200_OK)
 def suggest_move(game_id: int, coordinate: Coordinate = Body()):
 
+    # redis node holding the game
+    redis = redis_router.get(game_id)
+
     # make sure game exists
     if not game_exists(game_id, redis):
         return Response(status_code=status.HTTP_400_BAD_REQUEST,
                         content=f"Game with ID {game_id} does not exist.")
 
     # read current game
-    board = ChessBoard.from_redis(game_id, redis)
-    piece = board.get(coordinate)
+    board = ChessBoard.from_redis(game_id, redis, cache=position_cache)
+    sq = square_from_coordinate(coordinate)
+    piece = board.get(sq)
 
     # make sure chess piece exists on the board
     if not piece:
         return Response(status_code=status.HTTP_400_BAD_REQUEST,
                         content=f"Piece does not exist.")
 
-    return piece.get_valid_moves(board, coordinate)
+    with VALID_MOVES_SECONDS.time():
+        moves = board.get_valid_moves(sq)
+
+    return [coordinate_from_square(c) for c in moves]
+
+
+@app.get("/game/{game_id}/legal_moves", status_code=status.HTTP_200_OK)
+def get_legal_moves(game_id: int, if_none_match: Optional[str] = Header(default=None)):
+    """
+    Returns legal moves of the side to move, keyed by source square as "x,y".
+    Result only changes with the game stream, so it is tagged and cached
+    by the id of the last game stream entry.
+    """
+
+    # redis node holding the game
+    redis = redis_router.get(game_id)
+
+    # make sure game exists
+    if not game_exists(game_id, redis):
+        return Response(status_code=status.HTTP_400_BAD_REQUEST,
+                        content=f"Game with ID {game_id} does not exist.")
+
+    # client already has the moves of the current ply
+    ts = last_game_ts(game_id, redis)
+    if if_none_match == f'"{ts}"':
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                        headers={"ETag": f'"{ts}"'})
+
+    # serve moves computed for the current ply by any gateway
+    cached = redis.hgetall(legal_moves_key_from_id(game_id))
+    if cached.get("ts") == ts:
+        content = cached["moves"]
+
+    else:
+
+        # read current game
+        board = ChessBoard.from_redis(game_id, redis, cache=position_cache)
+        ts = str(board.ts)
+        with VALID_MOVES_SECONDS.time():
+            moves = board.legal_moves()
+        content = json.dumps({
+            f"{src & 7},{src >> 4}": [coordinate_from_square(c).dict() for c in dests]
+            for src, dests in moves.items()
+        })
+        save_game_hash(game_id, redis, legal_moves_key_from_id(game_id), {
+            "ts": ts,
+            "moves": content
+        })
+
+    return Response(content=content, media_type="application/json",
+                    headers={"ETag": f'"{ts}"', "Cache-Control": "no-cache"})
+
+
+@app.get("/game/{game_id}/book", status_code=status.HTTP_200_OK)
+def get_book_moves(game_id: int):
+    """
+    Returns known continuations of the current position along with times
+    each was played, most played first. Empty once the game leaves the book.
+    """
+
+    # redis node holding the game
+    redis = redis_router.get(game_id)
+
+    # make sure game exists
+    if not game_exists(game_id, redis):
+        return Response(status_code=status.HTTP_400_BAD_REQUEST,
+                        content=f"Game with ID {game_id} does not exist.")
+
+    # read current game
+    board = ChessBoard.from_redis(game_id, redis, cache=position_cache)
+
+    return [{"move": move.to_move(), "count": count} for move, count in board.book_moves()]
+
+
+@app.post("/game/{game_id}/analyze", status_code=status.HTTP_202_ACCEPTED)
+def analyze_game(game_id: int, depth: Optional[int] = Query(default=None, gt=0),
+                 nodes: Optional[int] = Query(default=None, gt=0), time: Optional[int] = Query(default=None, gt=0)):
+    """
+    Requests analysis of the current position from the analysis workers.
+    Result is sent to the game's websockets as an analysis game event.
+    Budgets (time in milliseconds) may only lower the analysis worker limits.
+    """
+
+    # redis node holding the game
+    redis = redis_router.get(game_id)
+
+    # make sure game exists
+    if not game_exists(game_id, redis):
+        return Response(status_code=status.HTTP_400_BAD_REQUEST,
+                        content=f"Game with ID {game_id} does not exist.")
+
+    write_event_to_analysis_worker(game_id, redis, ANALYSIS_STREAM_NAME, depth, nodes, time)
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Exposes metrics in prometheus text format."""
+
+    return Response(content=generate_metrics(), media_type=CONTENT_TYPE_LATEST)
@@ -2,9 +2,14 @@
 
 from fastapi.testclient import TestClient
 from fastapi.websockets import WebSocketState
-from gateway import app, redis as app_redis
+import asyncio
+import httpx
+import gateway
+from gateway import app, redis as app_redis, GameBroadcaster
 from redis import Redis
-from chess_utils import Move, MoveGameEvent, Coordinate, game_exists, expire_game, init_game, write_event_to_game
+from redis.asyncio import Redis as AsyncRedis
+from chess_utils import Move, MoveGameEvent, Coordinate, game_exists, expire_game, init_game, write_event_to_game, RedisRouter, \
+    ChessBoard, BoardMove, OpeningBook, write_opening_book, square
 from json import dumps
 
 client = TestClient(app)
@@ -50,3 +55,200 @@ def test_join_game():
     # assert moves are being transmitted
     with client.websocket_connect(f"/game/{game_id}/join") as websocket:
         assert MoveGameEvent(**websocket.receive_json()) == mge
+
+
+def test_suggest_move():
+
+    # init new game
+    game_id = 2
+    init_game(game_id, redis)
+
+    # assert pawn suggestions are converted back to coordinates
+    response = client.post(f"/game/{game_id}/suggest",
+                           data=dumps(Coordinate(x=0, y=6).dict()))
+    assert response.status_code == 200
+    assert [Coordinate(**c) for c in response.json()] == [
+        Coordinate(x=0, y=5), Coordinate(x=0, y=4)]
+
+    # assert 400 on empty square
+    assert client.post(f"/game/{game_id}/suggest",
+                       data=dumps(Coordinate(x=0, y=4).dict())).status_code == 400
+
+    # cleanup
+    expire_game(game_id, redis, 0)
+
+
+def test_legal_moves():
+
+    # init new game
+    game_id = 3
+    init_game(game_id, redis)
+
+    # assert all moves of the side to move are returned
+    response = client.get(f"/game/{game_id}/legal_moves")
+    assert response.status_code == 200
+    assert sum(len(dests) for dests in response.json().values()) == 20
+    assert [Coordinate(**c) for c in response.json()["6,7"]] == [
+        Coordinate(x=5, y=5), Coordinate(x=7, y=5)]
+
+    # assert unchanged game is not sent again
+    etag = response.headers["ETag"]
+    assert client.get(f"/game/{game_id}/legal_moves",
+                      headers={"If-None-Match": etag}).status_code == 304
+
+    # assert moves are recomputed after a move
+    write_event_to_game(game_id, redis, MoveGameEvent(move=Move(
+        src_coordinate=Coordinate(x=4, y=6), dest_coordinate=Coordinate(x=4, y=4))))
+    response = client.get(f"/game/{game_id}/legal_moves",
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert "1,0" in response.json() and "1,7" not in response.json()
+
+    # cleanup
+    expire_game(game_id, redis, 0)
+
+
+def test_broadcaster():
+
+    async def _test_broadcaster():
+
+        # prepare vars
+        game_id = 4
+        mges = [MoveGameEvent(move=Move(src_coordinate=Coordinate(x=x, y=6), dest_coordinate=Coordinate(
+            x=x, y=4))) for x in range(0, 2)]
+        async_redis = AsyncRedis(**redis.connection_pool.connection_kwargs)
+        broadcaster = GameBroadcaster(RedisRouter({"redis": async_redis}), queue_size=1)
+        init_game(game_id, redis)
+        write_event_to_game(game_id, redis, mges[0])
+
+        # assert events are fanned out to all subscribers
+        fast = broadcaster.subscribe(game_id)
+        slow = broadcaster.subscribe(game_id)
+        assert await fast.queue.get() == [mges[0].dict()]
+        assert len(broadcaster._games) == 1
+
+        # assert slow subscriber is dropped once its queue overflows
+        write_event_to_game(game_id, redis, mges[1])
+        assert await fast.queue.get() == [mges[1].dict()]
+        assert slow.dropped and await slow.queue.get() is None
+
+        # assert late subscribers get events read so far
+        late = broadcaster.subscribe(game_id)
+        assert late.backlog == [mge.dict() for mge in mges]
+
+        # cleanup
+        for subscriber in [fast, late]:
+            broadcaster.unsubscribe(game_id, subscriber)
+        expire_game(game_id, redis, 0)
+        await async_redis.close()
+
+    asyncio.run(_test_broadcaster())
+
+    # assert blocking game stream reads do not hold connections of the request pool
+    assert gateway.broadcaster.router is gateway.stream_redis_router
+    assert {id(r.connection_pool) for r in gateway.stream_redis_router.nodes}.isdisjoint(
+        id(r.connection_pool) for r in gateway.async_redis_router.nodes)
+
+
+def test_perform_move(monkeypatch):
+
+    def _move_validator(request: httpx.Request) -> httpx.Response:
+
+        # first replica is down
+        if request.url.host == "down":
+            raise httpx.ConnectError("connection refused", request=request)
+
+        return httpx.Response(201 if request.url.params["game_id"] == str(game_id) else 400)
+
+    # prepare vars
+    game_id = 5
+    url = f"/game/{game_id}/move"
+    data = dumps(Move(src_coordinate=Coordinate(
+        x=0, y=6), dest_coordinate=Coordinate(x=0, y=4)).dict())
+    monkeypatch.setattr(gateway, "MOVE_VALIDATOR_ENDPOINTS", [
+                        "http://down:8001", "http://up:8001"])
+    monkeypatch.setattr(gateway, "move_validator_turn", iter([0, 0]))
+    monkeypatch.setattr(gateway, "http_client", httpx.AsyncClient(
+        transport=httpx.MockTransport(_move_validator)))
+
+    # async endpoints are served by a single event loop
+    with TestClient(app) as client:
+
+        # assert 400 on non-existing game
+        assert client.post(url, data=data).status_code == 400
+
+        # assert move is retried against the next replica
+        init_game(game_id, redis)
+        assert client.post(url, data=data).status_code == 201
+
+        # assert 502 once all attempts fail
+        monkeypatch.setattr(gateway, "MOVE_VALIDATOR_ENDPOINTS", [
+                            "http://down:8001"])
+        assert client.post(url, data=data).status_code == 502
+
+    # cleanup
+    expire_game(game_id, redis, 0)
+
+
+def test_analyze_game():
+
+    # prepare vars
+    game_id = 7
+    stream = gateway.ANALYSIS_STREAM_NAME
+
+    # assert 400 on non-existing game
+    assert client.post(f"/game/{game_id}/analyze").status_code == 400
+
+    # assert request lands on the analysis stream along with its budgets
+    init_game(game_id, redis)
+    assert client.post(f"/game/{game_id}/analyze", params={"depth": 3}).status_code == 202
+    assert redis.xrange(stream)[-1][1] == {"game_id": str(game_id), "depth": "3"}
+
+    # assert non-positive budgets are rejected
+    assert client.post(f"/game/{game_id}/analyze", params={"time": 0}).status_code == 422
+
+    # cleanup
+    expire_game(game_id, redis, 0)
+    redis.delete(stream)
+
+
+def test_book_moves(monkeypatch, tmp_path):
+
+    # prepare vars
+    game_id = 8
+    path = str(tmp_path / "book.bin")
+    board = ChessBoard()
+    write_opening_book(path, {board.hash: [(src, dest, 3 if dest == square(4, 4) else 0)
+                                           for src, dests in board.legal_moves().items() for dest in dests]})
+
+    # assert 400 on non-existing game
+    assert client.get(f"/game/{game_id}/book").status_code == 400
+
+    # assert no continuations are known without a book
+    init_game(game_id, redis)
+    assert client.get(f"/game/{game_id}/book").json() == []
+
+    # assert continuations of book position are returned with their counts
+    monkeypatch.setattr(gateway.position_cache, "book", OpeningBook(path))
+    assert client.get(f"/game/{game_id}/book").json() == [
+        {"move": BoardMove(square(4, 6), square(4, 4)).to_move().dict(), "count": 3}]
+
+    # cleanup
+    gateway.position_cache.book.close()
+    expire_game(game_id, redis, 0)
+
+
+def test_metrics():
+
+    # prepare vars
+    game_id = 6
+
+    # assert redis round trips of game creation are counted
+    assert client.post(f"/game/{game_id}/create").status_code == 201
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'chess_redis_round_trips_count{endpoint="create_game"}' in response.text
+
+    # cleanup
+    expire_game(game_id, redis, 0)
@@ -0,0 +1 @@
+../utils/gunicorn.conf.py
\ No newline at end of file
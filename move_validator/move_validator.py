@@ -5,12 +5,24 @@ Move validator does exactly that, validate chess moves.
 It builds game state out of performed moves and then decides if provided move
 is valid. It then returns response to gateway and notifies endgame microservice
 via redis stream.
+
+Optionally, check / checkmate is detected inline on the board the move
+validator already holds and is written atomically along with the move.
+Endgame validator is only notified when inline checks exceed their time budget,
+so positions checked inline are also searched for a forced mate right away.
+
+Move is only written if no other move was written to the game since the
+board was built, so concurrent moves of the same game can not both pass.
 """
 
 import os
+import time
 import logging
-from redis import Redis
-from chess_utils import Move, ChessBoard, MoveGameEvent, game_exists, write_event_to_game, write_event_to_endgame_validator
+from typing import List, Tuple
+from chess_utils import Move, BoardMove, ChessBoard, GameEvent, MoveGameEvent, FINAL_GAME_EVENTS, game_exists, append_to_game, \
+    position_cache_from_env, redis_router_from_env, RoundTripMiddleware, generate_metrics, \
+    VALID_MOVES_SECONDS, FIND_CHECKS_SECONDS
+from prometheus_client import CONTENT_TYPE_LATEST
 from fastapi import FastAPI, Response, Body, status
 from fastapi.logger import logger as fastapi_logger
 
@@ -19,36 +31,107 @@ logger = logging.getLogger('gunicorn.error')
 fastapi_logger.handlers = logger.handlers
 fastapi_logger.setLevel(logging.DEBUG)
 
-redis = Redis(host=os.getenv("REDIS_HOST", "localhost"),
-              port=int(os.getenv("REDIS_PORT", "6379")),
-              db=0,
-              decode_responses=True)
+# games are spread across redis nodes, first node also holds data shared by all games
+redis_router = redis_router_from_env()
+redis = redis_router.nodes[0]
+position_cache = position_cache_from_env(redis)
 app = FastAPI()
+app.add_middleware(RoundTripMiddleware)
+
+ENDGAME_STREAM_NAME = os.getenv("ENDGAME_STREAM_NAME", "endgame")
+ENDGAME_SHARDS = int(os.getenv("ENDGAME_SHARDS", "1"))
+MOVE_LEDGER = os.getenv("MOVE_LEDGER", "false") == "true"
+INLINE_ENDGAME = os.getenv("INLINE_ENDGAME", "false") == "true"
+INLINE_ENDGAME_BUDGET = float(os.getenv("INLINE_ENDGAME_BUDGET", "5")) / 1000
+ENDGAME_MATE_MOVES = int(os.getenv("ENDGAME_MATE_MOVES", "0"))
+ENDGAME_MATE_NODES = int(os.getenv("ENDGAME_MATE_NODES", "10000"))
+
+# exponential moving average of inline check durations, in seconds
+INLINE_ENDGAME_SMOOTHING = 0.2
+inline_endgame_estimate = 0.0
+
+
+def check_endgame_inline(board: ChessBoard) -> Tuple[bool, List[GameEvent]]:
+    """
+    Checks board for check / checkmate / stalemate, then for a forced mate if the
+    game goes on and mate search is enabled, as the endgame validator would. Only
+    done if the checks are expected to fit into the time budget. Returns whether
+    board was checked along with the found events.
+    """
+
+    global inline_endgame_estimate
+
+    if not INLINE_ENDGAME:
+        return False, []
+
+    # estimate decays while checks are skipped, so budget is eventually retried
+    if inline_endgame_estimate > INLINE_ENDGAME_BUDGET:
+        inline_endgame_estimate *= 1 - INLINE_ENDGAME_SMOOTHING
+        return False, []
+
+    start = time.perf_counter()
+    event = board.find_checks()
+    FIND_CHECKS_SECONDS.observe(time.perf_counter() - start)
+    events = [event] if event else []
+
+    # endgame validator is not notified of checked boards, so mate search is bounded by its node budget here
+    if ENDGAME_MATE_MOVES and not isinstance(event, FINAL_GAME_EVENTS):
+        mate = board.find_forced_mate(ENDGAME_MATE_MOVES, ENDGAME_MATE_NODES)
+        if mate:
+            events.append(mate)
+
+    elapsed = time.perf_counter() - start
+    inline_endgame_estimate += INLINE_ENDGAME_SMOOTHING * (elapsed - inline_endgame_estimate)
+
+    return True, events
 
 
 @app.post("/validate", status_code=status.HTTP_201_CREATED)
 def validate_move(game_id: int, move: Move = Body()):
-    """Makes sure provided move is valid. Notifies endgame validator."""
+    """
+    Makes sure provided move is valid. Notifies endgame validator.
+    Returns 409 if game has moved on while move was being validated.
+    """
 
-    logger.info(f"validating move for game id {game_id}: {move}")
+    # lazy formatting, models are only dumped if logged
+    logger.info("validating move for game id %s: %s", game_id, move)
+
+    # redis node holding the game
+    redis = redis_router.get(game_id)
 
     # make sure game exists
     if not game_exists(game_id, redis):
         return Response(status_code=status.HTTP_400_BAD_REQUEST)
 
     # init board for given game
-    board = ChessBoard.from_redis(game_id, redis)
+    board = ChessBoard.from_redis(
+        game_id, redis, cache=position_cache, ledger=MOVE_LEDGER)
+    ply = board.ply
 
     # check if move is valid
-    if not board.move(move):
+    with VALID_MOVES_SECONDS.time():
+        valid = board.move(BoardMove.from_move(move))
+    if not valid:
         return Response(status_code=status.HTTP_400_BAD_REQUEST)
 
-    # append move to game
-    logger.info(f"appending valid move to game id {game_id}: {move}")
-    write_event_to_game(game_id, redis, MoveGameEvent(move=move))
+    checked, events = check_endgame_inline(board)
+
+    # append move to game, along with endgame events if board was checked.
+    # if game is over - mark game as finished. otherwise, if board was not
+    # checked - notify endgame validator
+    logger.info("appending valid move to game id %s: %s", game_id, move)
+    for event in events:
+        logger.info("game id %s: new event: %s", game_id, event)
+    if not append_to_game(game_id, redis, board.ts, [MoveGameEvent(move=move)] + events,
+                          timeout=60 if any(isinstance(event, FINAL_GAME_EVENTS) for event in events) else 0,
+                          endgame_stream=None if checked else ENDGAME_STREAM_NAME, shards=ENDGAME_SHARDS,
+                          ply=ply if MOVE_LEDGER else None):
+        logger.info("game id %s has moved on, rejecting move: %s", game_id, move)
+        return Response(status_code=status.HTTP_409_CONFLICT)
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Exposes metrics in prometheus text format."""
 
-    # notify endgame validator
-    logger.info(
-        f"sending game id {game_id} move notification to endgame validator")
-    write_event_to_endgame_validator(
-        game_id, redis, os.getenv("ENDGAME_STREAM_NAME", "endgame"))
+    return Response(content=generate_metrics(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1 @@
+../utils/test_chess_utils.py
\ No newline at end of file
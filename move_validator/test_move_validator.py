@@ -1,8 +1,12 @@
 #!/usr/bin/env python3.8
 
+import move_validator
 from fastapi.testclient import TestClient
 from move_validator import app, redis as app_redis
-from chess_utils import Move, Coordinate, init_game, game_exists
+from chess_utils import Move, Coordinate, ChessBoard, EventTypes, MoveGameEvent, ForcedMateGameEvent, \
+    square, init_game, game_exists, expire_game, append_to_game, snapshot_key_from_id, ledger_key_from_id, decode_game_event, \
+    stream_key_from_id, endgame_stream_key
+from chess_fixtures import Moves, GAME, FOOLS_MATE, to_move
 from redis import Redis
 from json import dumps
 
@@ -10,6 +14,16 @@ client = TestClient(app)
 redis: Redis = app_redis
 
 
+def _play(game_id: int, moves: Moves):
+    """Plays moves through the move validator, asserting each is accepted."""
+
+    for src, dest in moves:
+        assert client.post(
+            url="/validate",
+            data=dumps(to_move(src, dest).dict()),
+            params={"game_id": game_id}).status_code == 201
+
+
 def test_validate():
 
     # prepare vars
@@ -33,3 +47,109 @@ def test_validate():
 
     # assert invalid move returns 400
     assert client.post(**request).status_code == 400
+
+
+def test_snapshot():
+
+    # prepare vars
+    game_id = 2
+    init_game(game_id, redis)
+
+    # play the game through the move validator
+    _play(game_id, GAME)
+
+    # assert snapshot was stored and matches the game
+    board = ChessBoard.from_redis(game_id, redis)
+    assert redis.exists(snapshot_key_from_id(game_id))
+    assert board.ply == len(GAME)
+    assert board.to_snapshot() == ChessBoard.from_snapshot(
+        board.to_snapshot(), board.ply).to_snapshot()
+    assert board.get(square(5, 1)).is_white is False
+
+    # assert snapshot is removed along with the game
+    expire_game(game_id, redis, 0)
+    assert not redis.exists(snapshot_key_from_id(game_id))
+
+
+def test_inline_endgame(monkeypatch):
+
+    # prepare vars
+    game_id = 3
+    stream = endgame_stream_key(move_validator.ENDGAME_STREAM_NAME, 0)
+    monkeypatch.setattr(move_validator, "INLINE_ENDGAME", True)
+    init_game(game_id, redis)
+    redis.delete(stream)
+
+    # assert check over budget is left to endgame validator
+    monkeypatch.setattr(move_validator, "inline_endgame_estimate", 1.0)
+    _play(game_id, FOOLS_MATE[:1])
+    assert redis.xlen(stream) == 1
+
+    # assert boards checked inline are searched for a forced mate
+    monkeypatch.setattr(move_validator, "inline_endgame_estimate", 0.0)
+    monkeypatch.setattr(move_validator, "ENDGAME_MATE_MOVES", 1)
+    _play(game_id, FOOLS_MATE[1:3])
+    event = decode_game_event(redis.xrevrange(stream_key_from_id(game_id), count=1)[0][1])
+    assert event == ForcedMateGameEvent(white_wins=False, moves=1).dict()
+
+    # assert checkmate is written along with the move
+    monkeypatch.setattr(move_validator, "inline_endgame_estimate", 0.0)
+    _play(game_id, FOOLS_MATE[3:])
+    events = [decode_game_event(e[1]) for e in redis.xrevrange(stream_key_from_id(game_id), count=2)]
+    assert events[0]["event"] == EventTypes.CHECKMATE.value
+    assert events[1]["event"] == EventTypes.MOVE.value
+    assert redis.xlen(stream) == 1
+    assert redis.ttl(stream_key_from_id(game_id)) > 0
+
+    # cleanup
+    expire_game(game_id, redis, 0)
+    redis.delete(stream)
+
+
+def test_move_ledger(monkeypatch):
+
+    # prepare vars
+    game_id = 5
+    monkeypatch.setattr(move_validator, "MOVE_LEDGER", True)
+    init_game(game_id, redis)
+
+    # play the game through the move validator
+    _play(game_id, GAME)
+
+    # assert ledger holds two characters per move and matches the stream
+    assert redis.strlen(ledger_key_from_id(game_id)) == len(GAME) * 2
+    stream_board = ChessBoard.from_redis(game_id, redis)
+    ledger_board = ChessBoard.from_redis(game_id, redis, ledger=True)
+    assert ledger_board.ply == stream_board.ply == len(GAME)
+    assert ledger_board.to_snapshot() == stream_board.to_snapshot()
+    assert ledger_board.hash == stream_board.hash
+
+    # assert write behind the ledger is rejected
+    move = Move(src_coordinate=Coordinate(x=0, y=6), dest_coordinate=Coordinate(x=0, y=5))
+    assert not append_to_game(game_id, redis, None, [MoveGameEvent(move=move)], ply=len(GAME) - 1)
+    assert append_to_game(game_id, redis, None, [MoveGameEvent(move=move)], ply=len(GAME))
+
+    # assert ledger is removed along with the game
+    expire_game(game_id, redis, 0)
+    assert not redis.exists(ledger_key_from_id(game_id))
+
+
+def test_metrics():
+
+    # prepare vars
+    game_id = 6
+    init_game(game_id, redis)
+
+    # perform a move, so hot paths are timed
+    _play(game_id, GAME[:1])
+
+    # assert metrics are exposed, round trips are counted per endpoint
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "chess_board_replay_seconds_count" in response.text
+    assert "chess_valid_moves_seconds_count" in response.text
+    assert 'chess_redis_round_trips_count{endpoint="validate_move"}' in response.text
+    assert 'chess_redis_round_trips_sum{endpoint="validate_move"} 0.0' not in response.text
+
+    # cleanup
+    expire_game(game_id, redis, 0)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3.8
+
+"""
+Book builds an opening book out of PGN game collections.
+Every position reached within the first plies of the games is stored
+along with all of its legal moves and the times each of them was played,
+so services reading the book need not generate moves of those positions.
+
+Castling, en passant and promotion are not part of the rules, so a game
+is only followed up to the first move making use of any of them.
+"""
+
+import re
+import sys
+import argparse
+from typing import Dict, Iterator, List, Optional, Tuple
+from chess_utils import ChessBoard, BoardMove, OpeningBook, write_opening_book, square, \
+    PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING
+
+# piece letters of standard algebraic notation
+PIECES = {"": PAWN, "N": KNIGHT, "B": BISHOP, "R": ROOK, "Q": QUEEN, "K": KING}
+
+SAN = re.compile(r"^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(=[NBRQ])?[+#]?[!?]*$")
+COMMENTS = re.compile(r"\{[^}]*\}|;[^\n]*")
+VARIATIONS = re.compile(r"\([^()]*\)")
+TOKENS = re.compile(r"\d+\.+|\$\d+|1-0|0-1|1/2-1/2|\*")
+
+
+def read_games(path: str) -> Iterator[List[str]]:
+    """Reads SAN moves of each game in a PGN file."""
+
+    with open(path, encoding="utf-8", errors="replace") as f:
+        text = COMMENTS.sub(" ", f.read())
+
+    # nested variations are removed innermost first
+    while True:
+        text, removed = VARIATIONS.subn(" ", text)
+        if not removed:
+            break
+
+    moves: List[str] = []
+    for line in text.splitlines():
+
+        # tag pairs start the next game
+        if line.startswith("["):
+            if moves:
+                yield moves
+                moves = []
+            continue
+
+        moves.extend(TOKENS.sub(" ", line).split())
+
+    if moves:
+        yield moves
+
+
+def parse_san(board: ChessBoard, san: str) -> Optional[BoardMove]:
+    """Resolves SAN move against legal moves of current position, None if unsupported or ambiguous."""
+
+    match = SAN.match(san)
+    if not match or match.group(5):
+        return None
+
+    code = PIECES[match.group(1) or ""]
+    file, rank, dest = match.group(2), match.group(3), match.group(4)
+    dest_sq = square(ord(dest[0]) - ord("a"), 8 - int(dest[1]))
+
+    candidates = []
+    for src, dests in board.legal_moves().items():
+        if dest_sq not in dests or board.get(src).code != code:
+            continue
+        if file and ord(file) - ord("a") != src & 7:
+            continue
+        if rank and 8 - int(rank) != src >> 4:
+            continue
+        candidates.append(BoardMove(src, dest_sq))
+
+    return candidates[0] if len(candidates) == 1 else None
+
+
+def build(paths: List[str], plies: int, min_count: int) -> Dict[int, List[Tuple[int, int, int]]]:
+    """Counts moves played in each position, keyed by position hash."""
+
+    legal: Dict[int, Dict[int, List[int]]] = {}
+    visits: Dict[int, int] = {}
+    counts: Dict[int, Dict[Tuple[int, int], int]] = {}
+
+    for path in paths:
+        for game in read_games(path):
+
+            board = ChessBoard()
+            for san in game[:plies]:
+
+                move = parse_san(board, san)
+                if move is None:
+                    break
+
+                if board.hash not in legal:
+                    legal[board.hash] = board.legal_moves()
+                visits[board.hash] = visits.get(board.hash, 0) + 1
+                played = counts.setdefault(board.hash, {})
+                played[(move.src, move.dest)] = played.get((move.src, move.dest), 0) + 1
+
+                board.make(move)
+
+    # moves keep their generation order, so book positions behave just like generated ones
+    return {position_hash: [(src, dest, counts[position_hash].get((src, dest), 0))
+                            for src, dests in moves.items() for dest in dests]
+            for position_hash, moves in legal.items() if visits[position_hash] >= min_count}
+
+
+def main() -> int:
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("pgn", nargs="+",
+                        help="PGN files to build the book from")
+    parser.add_argument("-o", "--output", default="book.bin",
+                        help="opening book file to write (default: book.bin)")
+    parser.add_argument("-p", "--plies", type=int, default=20,
+                        help="plies of each game to follow (default: 20)")
+    parser.add_argument("-m", "--min-count", type=int, default=1,
+                        help="times a position must be reached to be stored (default: 1)")
+    args = parser.parse_args()
+
+    positions = build(args.pgn, args.plies, args.min_count)
+    write_opening_book(args.output, positions)
+
+    book = OpeningBook(args.output)
+    print(f"{args.output}: {len(positions)} positions, {len(book)} moves")
+    book.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
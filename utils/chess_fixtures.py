@@ -0,0 +1,40 @@
+#!/usr/bin/env python3.8
+
+"""
+Games and helpers shared by tests of the services. Games are
+lists of (src, dest) pairs of (x, y) coordinates.
+"""
+
+from typing import List, Tuple, Optional
+from redis import Redis
+from chess_utils import Move, Coordinate, MoveGameEvent, write_event_to_game, write_event_to_endgame_validator
+
+Moves = List[Tuple[Tuple[int, int], Tuple[int, int]]]
+
+GAME: Moves = [
+    ((4, 6), (4, 4)), ((4, 1), (4, 3)),
+    ((6, 7), (5, 5)), ((1, 0), (2, 2)),
+    ((5, 7), (2, 4)), ((6, 0), (5, 2)),
+    ((5, 5), (6, 3)), ((3, 1), (3, 3)),
+    ((4, 4), (3, 3)), ((5, 2), (3, 3)),
+    ((6, 3), (5, 1)), ((4, 0), (5, 1))
+]
+FOOLS_MATE: Moves = [((5, 6), (5, 5)), ((4, 1), (4, 3)), ((6, 6), (6, 4)), ((3, 0), (7, 4))]
+BISHOP_CHECK: Moves = [((4, 6), (4, 4)), ((4, 1), (4, 2)), ((3, 6), (3, 4)), ((5, 0), (1, 4))]
+HANGING_QUEEN: Moves = [((4, 6), (4, 4)), ((4, 1), (4, 3)), ((3, 7), (7, 3)), ((6, 0), (5, 2)), ((7, 3), (6, 4))]
+
+
+def to_move(src: Tuple[int, int], dest: Tuple[int, int]) -> Move:
+    """Builds move out of (x, y) coordinates."""
+
+    return Move(src_coordinate=Coordinate(x=src[0], y=src[1]),
+                dest_coordinate=Coordinate(x=dest[0], y=dest[1]))
+
+
+def write_moves(game_id: int, redis: Redis, moves: Moves, notify: Optional[str] = None):
+    """Writes moves to game stream, notifying given endgame stream after each move if any."""
+
+    for src, dest in moves:
+        write_event_to_game(game_id, redis, MoveGameEvent(move=to_move(src, dest)))
+        if notify:
+            write_event_to_endgame_validator(game_id, redis, notify)
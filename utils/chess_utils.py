@@ -5,21 +5,159 @@ Various utility functions and classes related to the
 overengineered game of chess.
 """
 
+import os
 import json
+import time
+import mmap
+import struct
+import random
+import bisect
+import hashlib
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import deque, OrderedDict
 from enum import Enum
-from typing import Literal, List, Union
-from pydantic import BaseModel, ValidationError
-from redis import Redis
+from typing import Literal, List, Dict, Union, Optional, Deque, Tuple, TypeVar, Generic, NamedTuple
+from pydantic import BaseModel
+from redis import Redis, ConnectionPool
+from redis.connection import Connection
+from redis.asyncio.connection import Connection as AsyncConnection
+from prometheus_client import Histogram, Gauge, CollectorRegistry, REGISTRY, generate_latest, multiprocess
 from abc import ABC, abstractmethod
 
 # list of all valid axis values
 VALID_COORDINATE = tuple([*range(0, 8)])
 
+# amount of game stream entries to read per redis round trip
+STREAM_PAGE_SIZE = 500
+
+# amount of replayed moves after which a new board snapshot is stored
+SNAPSHOT_INTERVAL = 10
+
+# move ledger stores each square as a single printable character, starting at "0"
+LEDGER_OFFSET = 48
+
+# opening book files start off a magic string, followed by fixed size records of
+# position hash, source square, destination square and times the move was played
+BOOK_MAGIC = b"CHESSBK1"
+BOOK_RECORD = struct.Struct("<QBBI")
+
+# histogram buckets of hot path timings, which take microseconds rather than seconds
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# metrics shared by all services
+REPLAY_SECONDS = Histogram("chess_board_replay_seconds",
+                           "Time to build a board out of redis", buckets=FAST_BUCKETS)
+REPLAYED_MOVES = Histogram("chess_board_replayed_moves",
+                           "Moves replayed on top of the snapshot while building a board", buckets=COUNT_BUCKETS)
+VALID_MOVES_SECONDS = Histogram("chess_valid_moves_seconds",
+                                "Time to find legal moves while serving a request", buckets=FAST_BUCKETS)
+FIND_CHECKS_SECONDS = Histogram("chess_find_checks_seconds",
+                                "Time to search for check / checkmate", buckets=FAST_BUCKETS)
+REDIS_ROUND_TRIPS = Histogram("chess_redis_round_trips",
+                              "Redis round trips per request", ["endpoint"], buckets=COUNT_BUCKETS)
+ENDGAME_QUEUE_DEPTH = Gauge("chess_endgame_queue_depth",
+                            "Messages waiting on an owned endgame stream shard", ["shard"], multiprocess_mode="livesum")
+ENDGAME_LAG_SECONDS = Histogram("chess_endgame_lag_seconds",
+                                "Time from endgame notification until it is handled")
+WEBSOCKET_FANOUT = Histogram("chess_websocket_fanout",
+                             "Websockets a batch of game events is sent to", buckets=COUNT_BUCKETS)
+ANALYSIS_SECONDS = Histogram("chess_analysis_seconds",
+                             "Time to analyse a position", buckets=(0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60))
+ANALYSIS_NODES = Histogram("chess_analysis_nodes",
+                           "Positions searched per analysis", buckets=(100, 1000, 10000, 100000, 1000000, 10000000))
+
+# round trips of the request being served, if they are being counted
+_redis_round_trips: ContextVar[Optional[List[int]]] = ContextVar("redis_round_trips", default=None)
+
+# points per redis node on the consistent hashing ring of RedisRouter
+ROUTER_VIRTUAL_NODES = 160
+
+# format of game events written to game streams. version 0 is a JSON "data"
+# field. version 1 is a compact "e" field: "m" followed by two move ledger
+# characters, "c" for check, "x1" / "x0" for checkmate won by white / black,
+# "s" for stalemate, "f1" / "f0" followed by the amount of moves for a mate
+# white / black can force, "a" followed by JSON fields of an analysis.
+# format version is stored in a "v" field, absent from version 0 entries
+GAME_EVENT_VERSION = 1
+GAME_EVENT_VERSIONS = (0, 1)
+
+# stores hash next to the game stream, unless the game is gone.
+# hash inherits stream expiration so finished games clean up after themselves
+SAVE_GAME_HASH_SCRIPT = """
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl == -2 then
+    return 0
+end
+redis.call('HSET', KEYS[2], unpack(ARGV))
+if ttl > 0 then
+    redis.call('PEXPIRE', KEYS[2], ttl)
+end
+return 1
+"""
+
+# appends events to the game stream and notifies endgame validator in one go.
+# write is rejected if the game is gone or a move was appended after the
+# entry the writer has seen - or, if the move ledger is used, unless the ledger
+# holds the expected amount of moves. keys past the game stream are the keys to
+# expire alongside it, fifth key is the endgame validator stream if it is to be
+# notified. returns length of the move ledger if it is used
+APPEND_TO_GAME_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if ARGV[2] ~= '' then
+    if redis.call('STRLEN', KEYS[4]) ~= tonumber(ARGV[2]) then
+        return 0
+    end
+else
+    for _, entry in ipairs(redis.call('XRANGE', KEYS[1], ARGV[1], '+')) do
+        local fields = entry[2]
+        if fields[1] == 'v' then
+            if fields[2] ~= '1' then
+                return redis.error_reply('unknown game event format version ' .. fields[2])
+            end
+            if string.sub(fields[4], 1, 1) == 'm' then
+                return 0
+            end
+        elseif cjson.decode(fields[2]).event == 'move' then
+            return 0
+        end
+    end
+end
+for i = 7, #ARGV do
+    if ARGV[6] == '0' then
+        redis.call('XADD', KEYS[1], '*', 'data', ARGV[i])
+    else
+        redis.call('XADD', KEYS[1], '*', 'v', ARGV[6], 'e', ARGV[i])
+    end
+end
+local length = 1
+if ARGV[2] ~= '' then
+    length = redis.call('APPEND', KEYS[4], ARGV[3])
+end
+if #KEYS == 5 then
+    redis.call('XADD', KEYS[5], '*', 'game_id', ARGV[4])
+end
+if tonumber(ARGV[5]) > 0 then
+    for i = 1, 4 do
+        redis.call('EXPIRE', KEYS[i], ARGV[5])
+    end
+end
+return length
+"""
+
 
 class EventTypes(Enum):
     MOVE = "move"
     CHECK = "check"
     CHECKMATE = "checkmate"
+    STALEMATE = "stalemate"
+    FORCED_MATE = "forced_mate"
+    ANALYSIS = "analysis"
 
 
 class Coordinate(BaseModel):
@@ -51,54 +189,373 @@ class CheckmateGameEvent(GameEvent):
     white_wins: bool
 
 
+class StalemateGameEvent(GameEvent):
+    event: str = EventTypes.STALEMATE.value
+
+
+class ForcedMateGameEvent(GameEvent):
+    event: str = EventTypes.FORCED_MATE.value
+    white_wins: bool
+    moves: int  # moves until mate, counting the winning side only
+
+
+class AnalysisGameEvent(GameEvent):
+    event: str = EventTypes.ANALYSIS.value
+    ply: int  # ply of the analysed position
+    depth: int
+    nodes: int
+    score: int  # centipawns, positive if white is better off
+    mate: Optional[int] = None  # moves until mate, positive if white mates, 0 if already mated
+    best_move: Optional[Move] = None
+
+
+# game event models by event type
+GAME_EVENTS = {
+    EventTypes.MOVE.value: MoveGameEvent,
+    EventTypes.CHECK.value: CheckGameEvent,
+    EventTypes.CHECKMATE.value: CheckmateGameEvent,
+    EventTypes.STALEMATE.value: StalemateGameEvent,
+    EventTypes.FORCED_MATE.value: ForcedMateGameEvent,
+    EventTypes.ANALYSIS.value: AnalysisGameEvent
+}
+
+# events which end the game
+FINAL_GAME_EVENTS = (CheckmateGameEvent, StalemateGameEvent)
+
+
+def parse_game_event(data: dict) -> GameEvent:
+    """Parses game event dict into its model."""
+
+    return GAME_EVENTS[data["event"]](**data)
+
+
+def game_event_version(fields: dict) -> int:
+    """Outputs format version of game stream entry fields, raises ValueError if it is unknown."""
+
+    version = int(fields.get("v", 0))
+    if version not in GAME_EVENT_VERSIONS:
+        raise ValueError(f"unknown game event format version {version}")
+
+    return version
+
+
+def encode_game_event(event: GameEvent, version: int = GAME_EVENT_VERSION) -> dict:
+    """
+    Encodes game event into game stream entry fields of given format version.
+    Raises ValueError on unknown versions, TypeError on unknown events.
+    """
+
+    if version not in GAME_EVENT_VERSIONS:
+        raise ValueError(f"unknown game event format version {version}")
+
+    if version == 0:
+        return {"data": json.dumps(event.dict())}
+
+    if isinstance(event, MoveGameEvent):
+        data = "m" + BoardMove.from_move(event.move).to_ledger()
+    elif isinstance(event, CheckmateGameEvent):
+        data = "x1" if event.white_wins else "x0"
+    elif isinstance(event, StalemateGameEvent):
+        data = "s"
+    elif isinstance(event, ForcedMateGameEvent):
+        data = ("f1" if event.white_wins else "f0") + str(event.moves)
+    elif isinstance(event, AnalysisGameEvent):
+        data = "a" + json.dumps(event.dict(exclude={"event"}), separators=(",", ":"))
+    elif isinstance(event, CheckGameEvent):
+        data = "c"
+    else:
+        raise TypeError(f"cannot encode game event {type(event).__name__}")
+
+    return {"v": version, "e": data}
+
+
+def decode_game_event(fields: dict) -> dict:
+    """
+    Decodes game stream entry fields of any format version into
+    game event dict, as produced by GameEvent.dict().
+    Raises ValueError on unknown versions and events.
+    """
+
+    if game_event_version(fields) == 0:
+        return json.loads(fields["data"])
+
+    data = fields["e"]
+
+    if data[0] == "m":
+        move = BoardMove.from_ledger(data[1:])[0]
+        return {"event": EventTypes.MOVE.value, "move": {
+            "src_coordinate": {"x": move.src & 7, "y": move.src >> 4},
+            "dest_coordinate": {"x": move.dest & 7, "y": move.dest >> 4}
+        }}
+
+    if data[0] == "x":
+        return {"event": EventTypes.CHECKMATE.value, "white_wins": data[1] == "1"}
+
+    if data[0] == "s":
+        return {"event": EventTypes.STALEMATE.value}
+
+    if data[0] == "f":
+        return {"event": EventTypes.FORCED_MATE.value, "white_wins": data[1] == "1", "moves": int(data[2:])}
+
+    if data[0] == "a":
+        return {"event": EventTypes.ANALYSIS.value, **json.loads(data[1:])}
+
+    if data == "c":
+        return {"event": EventTypes.CHECK.value}
+
+    raise ValueError(f"unknown game event {data!r}")
+
+
+# 0x88 board layout: square index is y * 16 + x, so any index
+# with one of the 0x88 bits set lies outside of the board
+OFF_BOARD = 0x88
+
+# piece codes stored on the board, color is stored in a separate bit
+EMPTY = 0
+PAWN = 1
+KNIGHT = 2
+BISHOP = 3
+ROOK = 4
+QUEEN = 5
+KING = 6
+WHITE = 8
+
+# all squares of the board in row order
+SQUARES = tuple([(y << 4) | x for y in range(0, 8) for x in range(0, 8)])
+
+
+def _leaps(offsets: List[tuple]) -> List[tuple]:
+    """Precomputes on-board target squares of given offsets for each square."""
+
+    table = [() for _ in range(0, 128)]
+    for sq in SQUARES:
+        table[sq] = tuple([sq + (x + y * 16) for x, y in offsets
+                           if not (sq + (x + y * 16)) & OFF_BOARD])
+    return table
+
+
+def _rays(directions: List[tuple]) -> List[tuple]:
+    """Precomputes on-board squares along given directions for each square."""
+
+    table = [() for _ in range(0, 128)]
+    for sq in SQUARES:
+        rays = []
+        for x, y in directions:
+            ray = []
+            c = sq + (x + y * 16)
+            while not c & OFF_BOARD:
+                ray.append(c)
+                c += x + y * 16
+            rays.append(tuple(ray))
+        table[sq] = tuple(rays)
+    return table
+
+
+# precomputed attack tables
+KNIGHT_MOVES = _leaps([
+    (-1, -2), (1, -2),
+    (2, -1), (2, 1),
+    (-1, 2), (1, 2),
+    (-2, -1), (-2, 1)
+])
+KING_MOVES = _leaps([
+    (-1, -1), (0, -1),
+    (1, -1), (1, 0),
+    (1, 1), (0, 1),
+    (-1, 1), (-1, 0)
+])
+ROOK_RAYS = _rays([(0, 1), (0, -1), (1, 0), (-1, 0)])
+BISHOP_RAYS = _rays([(1, 1), (1, -1), (-1, 1), (-1, -1)])
+QUEEN_RAYS = [ROOK_RAYS[sq] + BISHOP_RAYS[sq] for sq in range(0, 128)]
+
+# whether two squares share a row, column or diagonal, indexed by
+# the difference of their 0x88 indices offset by 119
+ALIGNED = [False for _ in range(0, 239)]
+for _y in range(-7, 8):
+    for _x in range(-7, 8):
+        ALIGNED[_y * 16 + _x + 119] = _x == 0 or _y == 0 or abs(_x) == abs(_y)
+
+
+def square(x: int, y: int) -> int:
+    """Converts raw axis values to a 0x88 board square. Raises ValueError if out of bounds."""
+
+    if not (0 <= x < 8 and 0 <= y < 8):
+        raise ValueError(f"coordinate out of bounds: ({x}, {y})")
+
+    return (y << 4) | x
+
+
+def square_from_coordinate(c: Coordinate) -> int:
+    """Converts coordinate to a 0x88 board square."""
+
+    return (c.y << 4) | c.x
+
+
+def coordinate_from_square(sq: int) -> Coordinate:
+    """Converts 0x88 board square to a coordinate."""
+
+    return COORDINATES[sq]
+
+
+# zobrist keys of each piece code on each square and of white's turn.
+# seed is fixed so hashes are the same across processes and hosts
+_zobrist_random = random.Random(0x88)
+ZOBRIST_PIECES = [[_zobrist_random.getrandbits(64) if code & 7 else 0 for _ in range(0, 128)]
+                  for code in range(0, 16)]
+ZOBRIST_WHITE_TURN = _zobrist_random.getrandbits(64)
+
+
+# coordinate of each square, so they are validated only once
+COORDINATES = {sq: Coordinate(x=(sq & 7), y=(sq >> 4)) for sq in SQUARES}
+
+
+class BoardMove:
+
+    """
+    Move between two 0x88 board squares. Used internally instead of Move,
+    which is only validated at the HTTP boundary.
+    """
+
+    __slots__ = ("src", "dest")
+
+    def __init__(self, src: int, dest: int) -> None:
+        self.src = src
+        self.dest = dest
+
+    @classmethod
+    def from_move(cls, move: Move) -> 'BoardMove':
+        return cls(square_from_coordinate(move.src_coordinate),
+                   square_from_coordinate(move.dest_coordinate))
+
+    @classmethod
+    def from_dict(cls, move: dict) -> 'BoardMove':
+        """Converts raw move dict, as stored in the game stream, skipping pydantic validation."""
+
+        return cls(square(move["src_coordinate"]["x"], move["src_coordinate"]["y"]),
+                   square(move["dest_coordinate"]["x"], move["dest_coordinate"]["y"]))
+
+    @classmethod
+    def from_fields(cls, fields: dict) -> Optional['BoardMove']:
+        """Parses move out of game stream entry fields, None if entry is not a move."""
+
+        if game_event_version(fields) == 1:
+            data = fields["e"]
+            return cls.from_ledger(data[1:])[0] if data[0] == "m" else None
+
+        data = json.loads(fields["data"])
+        return cls.from_dict(data["move"]) if data["event"] == EventTypes.MOVE.value else None
+
+    @classmethod
+    def from_ledger(cls, ledger: str) -> List['BoardMove']:
+        """Parses moves out of a move ledger, two characters per move."""
+
+        return [cls(SQUARES[ord(ledger[i]) - LEDGER_OFFSET], SQUARES[ord(ledger[i + 1]) - LEDGER_OFFSET])
+                for i in range(0, len(ledger) - 1, 2)]
+
+    def to_move(self) -> Move:
+        return Move(src_coordinate=COORDINATES[self.src],
+                    dest_coordinate=COORDINATES[self.dest])
+
+    def to_ledger(self) -> str:
+        """Serializes move into two move ledger characters."""
+
+        return chr(LEDGER_OFFSET + ((self.src >> 4) << 3 | (self.src & 7))) + \
+            chr(LEDGER_OFFSET + ((self.dest >> 4) << 3 | (self.dest & 7)))
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, BoardMove) and self.src == other.src and self.dest == other.dest
+
+    def __hash__(self) -> int:
+        return hash((self.src, self.dest))
+
+    def __repr__(self) -> str:
+        return f"BoardMove(src={self.src:#04x}, dest={self.dest:#04x})"
+
+
 class ChessPiece(ABC):
 
+    code: int = EMPTY
+
     def __init__(self, is_white: bool) -> None:
         self.is_white = is_white
+        self.color = WHITE if is_white else 0
 
     @abstractmethod
-    def get_valid_moves(self, board: 'ChessBoard', coordinate: Coordinate) -> List[Coordinate]:
+    def get_valid_moves(self, board: 'ChessBoard', sq: int) -> List[int]:
         pass
 
+    def _leap(self, board: 'ChessBoard', table: List[tuple], sq: int) -> List[int]:
+        """Moves of a piece which jumps to precomputed squares."""
 
-class Pawn(ChessPiece):
+        out = []
+        squares = board._squares
+
+        for c in table[sq]:
 
-    first_move: bool = True
+            piece = squares[c]
 
-    def get_valid_moves(self, board: 'ChessBoard', coordinate: Coordinate) -> List[Coordinate]:
+            # if empty space or opposite piece - append
+            if not piece or (piece & WHITE) != self.color:
+                out.append(c)
+
+        return out
+
+    def _slide(self, board: 'ChessBoard', table: List[tuple], sq: int) -> List[int]:
+        """Moves of a piece which slides along precomputed rays."""
 
         out = []
+        squares = board._squares
 
-        # check forward moves
-        for i in [1] + ([2] if self.first_move else []):
+        for ray in table[sq]:
+            for c in ray:
 
-            # derive xy of current iteration
-            try:
-                c = Coordinate(x=coordinate.x, y=(
-                    coordinate.y + (-i if self.is_white else i)))
-            except ValidationError:
-                break
+                piece = squares[c]
+
+                # if piece is encountered
+                if piece:
+
+                    # if piece is of opposite color - capture
+                    if (piece & WHITE) != self.color:
+                        out.append(c)
+
+                    break
 
-            # if any piece obstructs the move - not a valid move
-            if board.get(c) == None:
+                # empty spot
                 out.append(c)
-            else:
-                break
+
+        return out
+
+
+class Pawn(ChessPiece):
+
+    code = PAWN
+
+    def get_valid_moves(self, board: 'ChessBoard', sq: int) -> List[int]:
+
+        out = []
+        squares = board._squares
+        step = -16 if self.is_white else 16
+
+        # check forward moves, pawns can not move backwards so
+        # pawns on their initial row are the ones which have not moved yet
+        c = sq + step
+        if not c & OFF_BOARD and not squares[c]:
+            out.append(c)
+
+            if (sq >> 4) == (6 if self.is_white else 1) and not squares[c + step]:
+                out.append(c + step)
 
         # pawns capture diagonally, so diagonal moves are checked separately
         for i in [1, -1]:
 
-            # derive xy of current iteration
-            try:
-                c = Coordinate(x=(coordinate.x + i),
-                               y=(coordinate.y + (-1 if self.is_white else 1)))
-            except ValidationError:
+            c = sq + step + i
+            if c & OFF_BOARD:
                 continue
 
-            piece = board.get(c)
+            piece = squares[c]
 
             # if a chess piece exists and is of different color - capture
-            if piece and piece.is_white != self.is_white:
+            if piece and (piece & WHITE) != self.color:
                 out.append(c)
 
         return out
@@ -106,206 +563,266 @@ class Pawn(ChessPiece):
 
 class Rook(ChessPiece):
 
-    def get_valid_moves(self, board: 'ChessBoard', coordinate: Coordinate) -> List[Coordinate]:
+    code = ROOK
 
-        out = []
+    def get_valid_moves(self, board: 'ChessBoard', sq: int) -> List[int]:
+        return self._slide(board, ROOK_RAYS, sq)
 
-        for i in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
 
-            multiplier = 2
+class Knight(ChessPiece):
 
-            try:
+    code = KNIGHT
 
-                c = Coordinate(
-                    x=(coordinate.x + i[0]), y=(coordinate.y + i[1]))
-                piece = board.get(c)
+    def get_valid_moves(self, board: 'ChessBoard', sq: int) -> List[int]:
+        return self._leap(board, KNIGHT_MOVES, sq)
 
-                # while within borders
-                while piece != False:
 
-                    # if piece is encountered
-                    if piece:
+class Bishop(ChessPiece):
 
-                        # if piece is of opposite color - capture
-                        if piece.is_white != self.is_white:
-                            out.append(c)
+    code = BISHOP
 
-                        break
+    def get_valid_moves(self, board: 'ChessBoard', sq: int) -> List[int]:
+        return self._slide(board, BISHOP_RAYS, sq)
 
-                    # empty spot
-                    else:
-                        out.append(c)
 
-                    # advance
-                    c = Coordinate(
-                        x=(coordinate.x + (i[0] * multiplier)), y=(coordinate.y + (i[1] * multiplier)))
-                    multiplier += 1
-                    piece = board.get(c)
+class Queen(ChessPiece):
 
-            except ValidationError:
-                continue
+    code = QUEEN
 
-        return out
+    def get_valid_moves(self, board: 'ChessBoard', sq: int) -> List[int]:
+        return self._slide(board, QUEEN_RAYS, sq)
 
 
-class Knight(ChessPiece):
+class King(ChessPiece):
 
-    def get_valid_moves(self, board: 'ChessBoard', coordinate: Coordinate) -> List[Coordinate]:
+    code = KING
 
-        out = []
+    def get_valid_moves(self, board: 'ChessBoard', sq: int) -> List[int]:
 
-        # iterate all possible knight offsets
-        for i in [
-            (-1, -2), (1, -2),
-            (2, -1), (2, 1),
-            (-1, 2), (1, 2),
-            (-2, -1), (-2, 1)
-        ]:
-
-            try:
-                c = Coordinate(
-                    x=(coordinate.x + i[0]), y=(coordinate.y + i[1]))
-            except ValidationError:
-                continue
+        out = self._leap(board, KING_MOVES, sq)
 
-            piece = board.get(c)
+        # king is lifted off the board, so that it does not
+        # shield squares behind it from sliding pieces
+        squares = board._squares
+        piece = squares[sq]
+        squares[sq] = EMPTY
 
-            # if empty space or opposite pawn - append
-            if piece == None or (piece and piece.is_white != self.is_white):
-                out.append(c)
+        # filter out attacked squares
+        out = [c for c in out if not board.is_attacked(c, not self.is_white)]
+
+        squares[sq] = piece
 
         return out
 
 
-class Bishop(ChessPiece):
+# shared piece instances by their board code
+PIECES: List[Optional[ChessPiece]] = [None for _ in range(0, 16)]
+for _piece in [Pawn, Knight, Bishop, Rook, Queen, King]:
+    PIECES[_piece.code] = _piece(False)
+    PIECES[_piece.code | WHITE] = _piece(True)
 
-    def get_valid_moves(self, board: 'ChessBoard', coordinate: Coordinate) -> List[Coordinate]:
 
-        out = []
+class SearchBudgetExceeded(Exception):
+    """Search ran out of positions it was allowed to visit."""
 
-        for i in [(1, 1), (1, -1), (-1, 1), (-1, -1)]:
 
-            multiplier = 2
+class PositionCache:
 
-            try:
+    """
+    Bounded LRU cache of results computed for a position, keyed by
+    the zobrist hash of the position. Values must be JSON serializable.
+    If redis is provided, entries are also shared through redis so other
+    processes may use them. Safe to share between threads, redis is
+    accessed outside of the lock.
+    """
 
-                c = Coordinate(
-                    x=(coordinate.x + i[0]), y=(coordinate.y + i[1]))
-                piece = board.get(c)
+    # returned by get() when value is not cached
+    MISS = object()
 
-                # while within borders
-                while piece != False:
+    def __init__(self, maxsize: int = 4096, redis: Optional[Redis] = None, ttl: int = 3600,
+                 book: Optional['OpeningBook'] = None) -> None:
+        self.maxsize = maxsize
+        self.redis = redis
+        self.ttl = ttl
 
-                    # if piece is encountered
-                    if piece:
+        # read-only book of precomputed positions, consulted by boards before the cache
+        self.book = book
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
 
-                        # if piece is of opposite color - capture
-                        if piece.is_white != self.is_white:
-                            out.append(c)
+        # cache statistics
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
 
-                        break
+    def get(self, position_hash: int, field: str):
 
-                    # empty spot
-                    else:
-                        out.append(c)
+        key = (position_hash, field)
 
-                    # advance
-                    c = Coordinate(
-                        x=(coordinate.x + (i[0] * multiplier)), y=(coordinate.y + (i[1] * multiplier)))
-                    multiplier += 1
-                    piece = board.get(c)
+        # process-local tier
+        with self._lock:
+            value = self._entries.get(key, self.MISS)
+            if value is not self.MISS:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
 
-            except ValidationError:
-                continue
+        # redis tier
+        if self.redis:
+            value = self.redis.hget(position_key_from_hash(position_hash), field)
+            if value is not None:
+                value = json.loads(value)
+                with self._lock:
+                    self.redis_hits += 1
+                    self._store(key, value)
+                return value
 
-        return out
+        with self._lock:
+            self.misses += 1
+        return self.MISS
 
+    def put(self, position_hash: int, field: str, value) -> None:
 
-class Queen(ChessPiece):
+        with self._lock:
+            self._store((position_hash, field), value)
 
-    def get_valid_moves(self, board: 'ChessBoard', coordinate: Coordinate) -> List[Coordinate]:
+        if self.redis:
+            key = position_key_from_hash(position_hash)
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.hset(key, field, json.dumps(value))
+            pipeline.expire(key, self.ttl)
+            pipeline.execute()
 
-        return Rook(self.is_white).get_valid_moves(board, coordinate) \
-            + Bishop(self.is_white).get_valid_moves(board, coordinate)
+    def _store(self, key: tuple, value) -> None:
+        """Stores value in process-local tier, lock must be held."""
 
+        self._entries[key] = value
+        self._entries.move_to_end(key)
 
-class King(ChessPiece):
+        # evict least recently used entries
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class OpeningBook:
 
-    def _get_valid_moves(self, board: 'ChessBoard', coordinate: Coordinate, recursive: bool) -> List[Coordinate]:
+    """
+    Read-only book of positions reached in the opening, as written by
+    write_opening_book(). Each position holds all of its legal moves along
+    with the times each was played. File is memory mapped and binary searched
+    by position hash, so it is never read as a whole, and its pages are
+    shared by all processes reading the same file.
+    """
+
+    def __init__(self, path: str) -> None:
+
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._map[:len(BOOK_MAGIC)] != BOOK_MAGIC:
+            raise ValueError(f"not an opening book: {path}")
+
+        self._size = (len(self._map) - len(BOOK_MAGIC)) // BOOK_RECORD.size
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _record_at(self, i: int) -> Tuple[int, int, int, int]:
+        return BOOK_RECORD.unpack_from(self._map, len(BOOK_MAGIC) + i * BOOK_RECORD.size)
+
+    def lookup(self, position_hash: int) -> List[Tuple[int, int, int]]:
+        """Outputs source square, destination square and times played of each move of a position."""
+
+        # first record of the position
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record_at(mid)[0] < position_hash:
+                lo = mid + 1
+            else:
+                hi = mid
 
         out = []
+        while lo < self._size:
+            record = self._record_at(lo)
+            if record[0] != position_hash:
+                break
+            out.append(record[1:])
+            lo += 1
 
-        # iterate all possible king offsets
-        for i in [
-            (-1, -1), (0, -1),
-            (1, -1), (1, 0),
-            (1, 1), (0, 1),
-            (-1, 1), (-1, 0)
-        ]:
-
-            try:
-                c = Coordinate(
-                    x=(coordinate.x + i[0]), y=(coordinate.y + i[1]))
-            except ValidationError:
-                continue
+        return out
 
-            piece = board.get(c)
+    def legal_moves(self, position_hash: int) -> Optional[Dict[int, List[int]]]:
+        """Outputs legal moves of a book position keyed by source square, None if position is not in the book."""
 
-            # if empty space or opposite pawn - append
-            if piece == None or (piece and piece.is_white != self.is_white):
-                out.append(c)
+        records = self.lookup(position_hash)
+        if not records:
+            return None
 
-        if recursive:
+        out: Dict[int, List[int]] = {}
+        for src, dest, _ in records:
+            out.setdefault(src, []).append(dest)
 
-            bad_coordinates: List[Coordinate] = []
+        return out
 
-            def _is_bad_move(_c: Coordinate) -> bool:
+    def close(self) -> None:
+        self._map.close()
 
-                # iterate board
-                for y in range(0, 8):
 
-                    for x in range(0, 8):
+def write_opening_book(path: str, positions: Dict[int, List[Tuple[int, int, int]]]):
+    """
+    Writes opening book out of source square, destination square and times
+    played of each legal move of each position, keyed by position hash.
+    Records are sorted by position hash, moves of a position keep their order.
+    """
 
-                        piece = board._matrix[y][x]
+    with open(path, "wb") as f:
+        f.write(BOOK_MAGIC)
+        for position_hash in sorted(positions):
+            f.write(b"".join(BOOK_RECORD.pack(position_hash, src, dest, count)
+                             for src, dest, count in positions[position_hash]))
 
-                        # if piece is opposite color
-                        if piece and self.is_white != piece.is_white:
 
-                            # get moves of current piece
-                            if isinstance(piece, King):
-                                coordinates = piece._get_valid_moves(
-                                    board, Coordinate(x=x, y=y), False)
-                            else:
-                                coordinates = piece.get_valid_moves(
-                                    board, Coordinate(x=x, y=y))
+def position_cache_from_env(redis: Redis) -> PositionCache:
+    """
+    Builds position cache of POSITION_CACHE_SIZE entries. Results are shared
+    through given redis if POSITION_CACHE_REDIS is true, and book positions are
+    answered out of the opening book at OPENING_BOOK, if any.
+    """
 
-                            # if one of the moves matches the new king's location - filter out
-                            if _c in coordinates:
-                                return True
+    return PositionCache(int(os.getenv("POSITION_CACHE_SIZE", "4096")),
+                         redis if os.getenv("POSITION_CACHE_REDIS", "false") == "true" else None,
+                         book=OpeningBook(os.environ["OPENING_BOOK"]) if os.getenv("OPENING_BOOK") else None)
 
-                return False
 
-            for new_coordinate in out:
+class Position(NamedTuple):
 
-                # perform move on new coordinate
-                board._move(Move(
-                    src_coordinate=coordinate,
-                    dest_coordinate=new_coordinate
-                ))
+    """
+    Immutable position: piece code of each of the 64 squares, packed row by
+    row, along with the side to move. Castling and en passant are not part
+    of the rules, so there are no further rights. Being a tuple of bytes,
+    positions are hashable, compared by value and cheap to pickle, so they
+    may be cached or handed to other threads and processes as they are.
+    """
 
-                if _is_bad_move(new_coordinate):
-                    bad_coordinates.append(new_coordinate)
+    squares: bytes
+    white_to_move: bool
 
-                # undo the move
-                board.undo()
+    def make(self, move: BoardMove) -> 'Position':
+        """Outputs position following given move, skipping validation."""
 
-            # filter out bad coordinates
-            out = [_c for _c in out if _c not in bad_coordinates]
+        src = (move.src >> 4) << 3 | (move.src & 7)
+        dest = (move.dest >> 4) << 3 | (move.dest & 7)
 
-        return out
+        squares = bytearray(self.squares)
+        squares[dest] = squares[src]
+        squares[src] = EMPTY
 
-    def get_valid_moves(self, board: 'ChessBoard', coordinate: Coordinate) -> List[Coordinate]:
-        return self._get_valid_moves(board, coordinate, True)
+        return Position(bytes(squares), not self.white_to_move)
 
 
 class ChessBoard:
@@ -318,127 +835,325 @@ class ChessBoard:
 
     class HistoryMove:
 
-        def __init__(self, move: Move, src_piece: ChessPiece, dest_piece: ChessPiece) -> None:
-            self.move = move
+        """
+        Everything needed to take a move back: both squares, the piece codes
+        they held and the hash of the position before the move. Pawn first
+        moves follow from their home row, while castling and en passant are
+        not part of the rules, so there are no further rights to restore.
+        """
+
+        __slots__ = ("src", "dest", "src_piece", "dest_piece", "hash")
+
+        def __init__(self, src: int, dest: int, src_piece: int, dest_piece: int, hash: int) -> None:
+            self.src = src
+            self.dest = dest
             self.src_piece = src_piece
             self.dest_piece = dest_piece
+            self.hash = hash
 
-    def __init__(self) -> None:
+    # snapshot letter of each piece code, uppercase for white
+    SNAPSHOT_LETTERS = ".pnbrqk"
 
-        # init empty chess board matrix
-        self._matrix: List[List[Union[ChessPiece, None]]] = [
-            [None for _ in range(0, 8)] for _ in range(0, 8)]
-        self.history: List[self.HistoryMove] = []
+    # initial row of pieces
+    INITIAL_ROW = [ROOK, KNIGHT, BISHOP, QUEEN, KING, BISHOP, KNIGHT, ROOK]
 
-        # spawn pawns
-        for y in [(1, False), (6, True)]:
-            for x in range(0, 8):
-                self._matrix[y[0]][x] = Pawn(y[1])
+    def __init__(self, cache: Optional[PositionCache] = None) -> None:
 
-        # spawn rooks
-        for y in [(0, False), (7, True)]:
-            for x in [0, 7]:
-                self._matrix[y[0]][x] = Rook(y[1])
+        # cache of position related results, if any
+        self.cache = cache
+
+        # init 0x88 chess board, only the left half of each row is used
+        self._squares = bytearray(128)
+        self.history: List[self.HistoryMove] = []
 
-        # spawn knights
-        for y in [(0, False), (7, True)]:
-            for x in [1, 6]:
-                self._matrix[y[0]][x] = Knight(y[1])
+        # amount of moves performed since the start of the game
+        self.ply = 0
 
-        # spawn bishops
-        for y in [(0, False), (7, True)]:
-            for x in [2, 5]:
-                self._matrix[y[0]][x] = Bishop(y[1])
+        # id of the last game stream entry this board covers
+        self.ts = 0
 
-        # spawn queens
-        for y in [(0, False), (7, True)]:
-            self._matrix[y[0]][3] = Queen(y[1])
+        # spawn pieces
+        for x in range(0, 8):
+            self._squares[x] = self.INITIAL_ROW[x]
+            self._squares[0x10 | x] = PAWN
+            self._squares[0x60 | x] = PAWN | WHITE
+            self._squares[0x70 | x] = self.INITIAL_ROW[x] | WHITE
 
-        # spawn kings
-        for y in [(0, False), (7, True)]:
-            self._matrix[y[0]][4] = King(y[1])
+        # king squares by color, None if king is captured
+        self._kings: List[Optional[int]] = [0x04, 0x74]
+
+        # zobrist hash of the position, updated on every move
+        self.hash = self._compute_hash()
 
     @classmethod
-    def from_redis(cls, game_id: int, redis: Redis) -> 'ChessBoard':
+    def from_redis(cls, game_id: int, redis: Redis, page_size: Optional[int] = STREAM_PAGE_SIZE,
+                   cache: Optional[PositionCache] = None, ledger: bool = False) -> 'ChessBoard':
+        """
+        Builds game board out of the latest snapshot and the moves
+        performed since. Stores a new snapshot if too many moves had to
+        be replayed. Moves are read in pages of page_size entries,
+        None reads the whole stream at once.
+
+        If ledger is set, moves are read from the game's move ledger
+        along with the snapshot instead. Stream position (ts) is then
+        unknown, so no snapshot is stored.
+        """
 
         # custom game move iterator, because why not
         class Game:
 
-            def __init__(self, game_id: int, redis: Redis):
+            def __init__(self, game_id: int, redis: Redis, ts, page_size: Optional[int]):
                 self.redis = redis
                 self.stream_key = stream_key_from_id(game_id)
-                self.ts = 0
+                self.ts = ts
+                self.page_size = page_size
+                self.moves: Deque[BoardMove] = deque()
+                self.exhausted = False
 
             def __iter__(self):
                 return self
 
-            def __next__(self) -> Move:
+            def _read_page(self):
 
-                while True:
+                # read next page of entries following the last read one
+                entries = self.redis.xrange(self.stream_key,
+                                            min=f"({self.ts}" if self.ts else "-",
+                                            count=self.page_size)
 
-                    # read next move from redis
-                    move = redis.xread({self.stream_key: self.ts}, count=1)
+                # short page means there is nothing left to read
+                if not self.page_size or len(entries) < self.page_size:
+                    self.exhausted = True
 
-                    if move:
+                if entries:
 
-                        # store timestamp and return parsed move
-                        self.ts = move[0][1][0][0]
-                        move_data = json.loads(move[0][1][0][1]["data"])
+                    # store timestamp and parse moves of the whole page
+                    self.ts = entries[-1][0]
+                    self.moves.extend(
+                        move for move in
+                        (BoardMove.from_fields(fields) for _, fields in entries)
+                        if move
+                    )
 
-                        if move_data["event"] == EventTypes.MOVE.value:
-                            return Move(**move_data["move"])
+            def __next__(self) -> BoardMove:
 
-                    else:
+                while not self.moves:
 
+                    if self.exhausted:
                         raise StopIteration
 
-        # add each move to chessboard
-        board = cls()
-        for move in Game(game_id, redis):
-            board.move(move)
+                    self._read_page()
+
+                return self.moves.popleft()
+
+        start = time.perf_counter()
+
+        # start off the latest snapshot if there is one
+        if ledger:
+            pipeline = redis.pipeline(transaction=False)
+            pipeline.hgetall(snapshot_key_from_id(game_id))
+            pipeline.get(ledger_key_from_id(game_id))
+            snapshot, moves = pipeline.execute()
+        else:
+            snapshot = redis.hgetall(snapshot_key_from_id(game_id))
+
+        if snapshot:
+            board = cls.from_snapshot(
+                snapshot["board"], int(snapshot["ply"]), cache)
+            board.ts = snapshot["ts"]
+        else:
+            board = cls(cache)
+
+        if ledger:
+            replayed = BoardMove.from_ledger((moves or "")[board.ply * 2:])
+            for move in replayed:
+                board.make(move)
+            board.ts = None
+            REPLAY_SECONDS.observe(time.perf_counter() - start)
+            REPLAYED_MOVES.observe(len(replayed))
+            return board
+
+        # add each move to chessboard, moves were validated before
+        # they were written to the game, so there is no need to revalidate
+        game = Game(game_id, redis, board.ts, page_size)
+        replayed = 0
+        for move in game:
+            board.make(move)
+            replayed += 1
+        board.ts = game.ts
+
+        if replayed >= SNAPSHOT_INTERVAL:
+            board.save_snapshot(game_id, redis)
+
+        REPLAY_SECONDS.observe(time.perf_counter() - start)
+        REPLAYED_MOVES.observe(replayed)
+
+        return board
+
+    @classmethod
+    def from_snapshot(cls, snapshot: str, ply: int, cache: Optional[PositionCache] = None) -> 'ChessBoard':
+        """Builds board out of a snapshot string produced by to_snapshot()."""
+
+        board = cls(cache)
+        board.ply = ply
+
+        board._kings = [None, None]
+        for sq, letter in zip(SQUARES, snapshot):
+            board._squares[sq] = cls.SNAPSHOT_LETTERS.index(letter.lower()) \
+                | (WHITE if letter.isupper() else 0)
+
+            if board._squares[sq] & 7 == KING:
+                board._kings[letter.isupper()] = sq
+
+        board.hash = board._compute_hash()
+
+        return board
+
+    @classmethod
+    def from_fen(cls, fen: str, cache: Optional[PositionCache] = None) -> 'ChessBoard':
+        """
+        Builds board out of a position in Forsyth-Edwards notation. Side to
+        move and move number are kept in ply. Castling and en passant fields
+        are ignored, as neither is part of the rules.
+        """
+
+        fields = fen.split()
+        rows = fields[0].split("/")
+        snapshot = "".join("." * int(letter) if letter.isdigit() else letter
+                           for row in rows for letter in row)
+
+        if len(rows) != 8 or len(snapshot) != 64:
+            raise ValueError(f"invalid FEN piece placement: {fields[0]}")
+
+        black_to_move = len(fields) > 1 and fields[1] == "b"
+        fullmove = int(fields[5]) if len(fields) > 5 else 1
+
+        return cls.from_snapshot(snapshot, 2 * (fullmove - 1) + black_to_move, cache)
+
+    @classmethod
+    def from_position(cls, position: Position, ply: Optional[int] = None,
+                      cache: Optional[PositionCache] = None) -> 'ChessBoard':
+        """
+        Builds board out of an immutable position. Unless given,
+        ply is the lowest one matching the side to move.
+        """
+
+        board = cls(cache)
+        board.ply = (0 if position.white_to_move else 1) if ply is None else ply
+
+        for y in range(0, 8):
+            board._squares[y << 4:(y << 4) + 8] = position.squares[y << 3:(y << 3) + 8]
+
+        board._kings = [None, None]
+        for is_white in [False, True]:
+            sq = position.squares.find(KING | (WHITE if is_white else 0))
+            if sq != -1:
+                board._kings[is_white] = SQUARES[sq]
+
+        board.hash = board._compute_hash()
+
+        return board
+
+    def to_position(self) -> Position:
+        """Outputs immutable copy of the current position."""
+
+        squares = self._squares
+        return Position(b"".join(squares[y << 4:(y << 4) + 8] for y in range(0, 8)), self.is_white_turn())
+
+    def copy(self) -> 'ChessBoard':
+        """
+        Outputs independent board in the same position. History entries
+        are never modified once made, so they are shared with the copy.
+        """
+
+        board = self.__class__.__new__(self.__class__)
+        board.cache = self.cache
+        board._squares = self._squares[:]
+        board.history = self.history[:]
+        board.ply = self.ply
+        board.ts = self.ts
+        board._kings = self._kings[:]
+        board.hash = self.hash
 
         return board
 
-    def get(self, c: Coordinate):
+    def to_snapshot(self) -> str:
+        """Serializes chess pieces into a string of 64 letters."""
+
+        out = ""
+
+        for sq in SQUARES:
+
+            piece = self._squares[sq]
+            letter = self.SNAPSHOT_LETTERS[piece & 7]
+            out += letter.upper() if piece & WHITE else letter
+
+        return out
+
+    def save_snapshot(self, game_id: int, redis: Redis) -> bool:
+        """
+        Stores board snapshot next to the game stream.
+        Returns False if game does not exist.
+        """
+
+        return save_game_hash(game_id, redis, snapshot_key_from_id(game_id), {
+            "ts": self.ts,
+            "ply": self.ply,
+            "board": self.to_snapshot()
+        })
+
+    def get(self, sq: int):
         """
         Gets an element from the chess board.
         Returns ChessPiece if there is a chess price.
         Returns None if no chess piece.
-        Returns False if coordinate out of bounds.
+        Returns False if square out of bounds.
         """
 
-        try:
-            return self._matrix[c.y][c.x]
-        except IndexError:
+        if sq & ~0x77:
             return False
 
-    def _move(self, move: Move) -> None:
+        return PIECES[self._squares[sq]]
+
+    def make(self, move: BoardMove) -> 'ChessBoard.HistoryMove':
         """
-        Performs move on a chessboard without validation.
+        Performs move on a chessboard without validation, meant for moves
+        known to be legal, such as the ones out of legal_moves().
+        Returns history entry of the move. Reversed by unmake().
         """
 
+        squares = self._squares
+
         # store move in history
         history_move = self.HistoryMove(
-            move,
-            self._matrix[move.src_coordinate.y][move.src_coordinate.x],
-            self._matrix[move.dest_coordinate.y][move.dest_coordinate.x]
-        )
+            move.src, move.dest, squares[move.src], squares[move.dest], self.hash)
         self.history.append(history_move)
+        self.ply += 1
+
+        # update hash with the moved piece, captured piece and turn
+        self.hash ^= ZOBRIST_PIECES[squares[move.src]][move.src] \
+            ^ ZOBRIST_PIECES[squares[move.src]][move.dest] \
+            ^ ZOBRIST_PIECES[squares[move.dest]][move.dest] \
+            ^ ZOBRIST_WHITE_TURN
+
+        # keep track of kings
+        if squares[move.src] & 7 == KING:
+            self._kings[bool(squares[move.src] & WHITE)] = move.dest
+        if squares[move.dest] & 7 == KING:
+            self._kings[bool(squares[move.dest] & WHITE)] = None
 
         # move piece
-        self._matrix[move.dest_coordinate.y][move.dest_coordinate.x] = history_move.src_piece
-        self._matrix[move.src_coordinate.y][move.src_coordinate.x] = None
+        squares[move.dest] = squares[move.src]
+        squares[move.src] = EMPTY
 
-        if isinstance(history_move.src_piece, Pawn):
-            history_move.src_piece.first_move = False
+        return history_move
 
-    def move(self, move: Move) -> bool:
+    def move(self, move: BoardMove) -> bool:
         """
         Performs move on a chessboard.
         Returns True if successful, otherwise False.
         """
 
-        piece = self.get(move.src_coordinate)
+        piece = self.get(move.src)
 
         # make sure source is a valid piece
         if not piece:
@@ -449,11 +1164,11 @@ class ChessBoard:
             return False
 
         # make sure move itself is valid
-        if move.dest_coordinate not in piece.get_valid_moves(self, move.src_coordinate):
+        if move.dest not in self.get_valid_moves(move.src):
             return False
 
         # move piece
-        self._move(move)
+        self.make(move)
 
         return True
 
@@ -465,73 +1180,485 @@ class ChessBoard:
         """
 
         try:
-            history_move = self.history.pop()
+            self.unmake()
         except IndexError:
             return False
 
+        return True
+
+    def unmake(self) -> 'ChessBoard.HistoryMove':
+        """
+        Reverses the last performed move in constant time.
+        Returns its history entry, raises IndexError if history is empty.
+        """
+
+        history_move = self.history.pop()
+
         # undo move
-        self._matrix[history_move.move.src_coordinate.y][history_move.move.src_coordinate.x] = history_move.src_piece
-        self._matrix[history_move.move.dest_coordinate.y][history_move.move.dest_coordinate.x] = history_move.dest_piece
+        self._squares[history_move.src] = history_move.src_piece
+        self._squares[history_move.dest] = history_move.dest_piece
+        self.ply -= 1
+        self.hash = history_move.hash
 
-        # handle pawn first move edgecase
-        pawn_first_move = True
-        if isinstance(history_move.src_piece, Pawn):
+        # restore kings
+        for sq, piece in [(history_move.src, history_move.src_piece), (history_move.dest, history_move.dest_piece)]:
+            if piece & 7 == KING:
+                self._kings[bool(piece & WHITE)] = sq
 
-            # if the same pawn has been found - not first move
-            for _history_move in self.history:
-                if _history_move.src_piece == history_move.src_piece:
-                    pawn_first_move = False
-                    break
+        return history_move
+
+    def _compute_hash(self) -> int:
+        """Computes zobrist hash of the position from scratch."""
+
+        out = ZOBRIST_WHITE_TURN if self.is_white_turn() else 0
+        for sq in SQUARES:
+            out ^= ZOBRIST_PIECES[self._squares[sq]][sq]
+
+        return out
+
+    def _get_legal_moves(self, sq: int, piece: ChessPiece, in_check: Optional[bool] = None) -> List[int]:
+        """
+        Filters valid moves of a piece down to the ones
+        which do not leave its own king under attack.
+        Whether the king is in check is computed unless given.
+        """
+
+        # king already filters out attacked squares on its own
+        if isinstance(piece, King):
+            return piece.get_valid_moves(self, sq)
+
+        # pieces off the lines of their king can not be pinned,
+        # so unless the king is in check, their moves are all legal
+        king = self._kings[piece.is_white]
+        if king is None:
+            return piece.get_valid_moves(self, sq)
+        if in_check is None:
+            in_check = self.is_attacked(king, not piece.is_white)
+        if not in_check and not ALIGNED[sq - king + 119]:
+            return piece.get_valid_moves(self, sq)
+
+        out = []
+
+        for c in piece.get_valid_moves(self, sq):
+
+            self.make(BoardMove(sq, c))
+            if not self.is_in_check(piece.is_white):
+                out.append(c)
+            self.unmake()
+
+        return out
+
+    def get_valid_moves(self, sq: int) -> List[int]:
+        """
+        Gets legal moves of a piece on given square.
+        Consults opening book and position cache first, if any.
+        """
+
+        piece = self.get(sq)
+        if not piece:
+            return []
+
+        if self.cache is None:
+            return self._get_legal_moves(sq, piece)
+
+        # book only holds moves of the side to move
+        if self.cache.book is not None and piece.is_white == self.is_white_turn():
+            moves = self.cache.book.legal_moves(self.hash)
+            if moves is not None:
+                return moves.get(sq, [])
+
+        field = f"moves-{sq}"
+        out = self.cache.get(self.hash, field)
+        if out is PositionCache.MISS:
+            out = self._get_legal_moves(sq, piece)
+            self.cache.put(self.hash, field, out)
+
+        return list(out)
+
+    def legal_moves(self) -> Dict[int, List[int]]:
+        """
+        Generates legal moves of every piece of the side to move in one pass.
+        Returns a dict of destination squares keyed by source square,
+        pieces without legal moves are omitted.
+        Consults opening book and position cache first, if any.
+        """
+
+        if self.cache is None:
+            return self._legal_moves()
+
+        if self.cache.book is not None:
+            out = self.cache.book.legal_moves(self.hash)
+            if out is not None:
+                return out
+
+        out = self.cache.get(self.hash, "legal")
+        if out is not PositionCache.MISS:
+            return {src: list(dests) for src, dests in out}
+
+        out = self._legal_moves()
+        # cached moves are stored as tuples, so callers changing the result cannot alter them
+        self.cache.put(self.hash, "legal", [(src, tuple(dests)) for src, dests in out.items()])
+
+        return out
+
+    def book_moves(self) -> List[Tuple[BoardMove, int]]:
+        """
+        Outputs known continuations of current position along with times
+        each was played, most played first. Empty without an opening book.
+        """
+
+        if self.cache is None or self.cache.book is None:
+            return []
+
+        out = [(BoardMove(src, dest), count) for src, dest, count in self.cache.book.lookup(self.hash) if count]
+
+        return sorted(out, key=lambda m: m[1], reverse=True)
+
+    def _legal_moves(self) -> Dict[int, List[int]]:
+        """Generates legal moves of the side to move, bypassing position cache."""
 
-            history_move.src_piece.first_move = pawn_first_move
+        out = {}
+        is_white = self.is_white_turn()
+        color = WHITE if is_white else 0
+        in_check = self.is_in_check(is_white)
+
+        for sq in SQUARES:
+
+            piece = self._squares[sq]
+
+            # only pieces of the side to move
+            if piece and (piece & WHITE) == color:
+                moves = self._get_legal_moves(sq, PIECES[piece], in_check)
+                if moves:
+                    out[sq] = moves
+
+        return out
+
+    def is_attacked(self, sq: int, by_white: bool) -> bool:
+        """
+        Checks whether a square is attacked by pieces of given color.
+        Casts rays and jumps from the square itself instead of
+        generating moves of every piece on the board.
+        """
+
+        squares = self._squares
+        color = WHITE if by_white else 0
+
+        # knights and kings
+        for table, piece in [(KNIGHT_MOVES, KNIGHT), (KING_MOVES, KING)]:
+            for c in table[sq]:
+                if squares[c] == piece | color:
+                    return True
+
+        # pawns attack diagonally towards the opposite side
+        for i in [1, -1]:
+            c = sq + (16 if by_white else -16) + i
+            if not c & OFF_BOARD and squares[c] == PAWN | color:
+                return True
+
+        # sliding pieces, first piece on each ray is the only one which may attack
+        for table, pieces in [(ROOK_RAYS, (ROOK | color, QUEEN | color)),
+                              (BISHOP_RAYS, (BISHOP | color, QUEEN | color))]:
+            for ray in table[sq]:
+                for c in ray:
+                    if squares[c]:
+                        if squares[c] in pieces:
+                            return True
+                        break
+
+        return False
+
+    def is_in_check(self, is_white: bool) -> bool:
+        """Checks whether king of given color is attacked."""
+
+        king = self._kings[is_white]
+        return king is not None and self.is_attacked(king, not is_white)
 
     def find_checks(self):
         """
         Searches for existing check or checkmate.
         Returns appropriate object if found.
         Returns None otherwise.
+        Consults position cache first, if any.
         """
 
-        for y in range(0, 8):
-            for x in range(0, 8):
+        if self.cache is None:
+            return self._find_checks()
 
-                c = Coordinate(x=x, y=y)
-                piece = self.get(c)
+        event = self.cache.get(self.hash, "checks")
+        if event is PositionCache.MISS:
+            event = self._find_checks()
+            self.cache.put(self.hash, "checks", event and event.dict())
+        elif event is not None:
+            event = parse_game_event(event)
 
-                # if piece is found
-                if piece:
+        return event
+
+    def _find_checks(self):
+
+        is_white_turn = self.is_white_turn()
+        in_check = self.is_in_check(is_white_turn)
+
+        # game goes on as long as the side to move has a legal move,
+        # be it a king move, a block or a capture of the checking piece
+        if self.has_legal_moves(in_check):
+            return CheckGameEvent() if in_check else None
+
+        # out of moves - checkmate if in check, stalemate otherwise
+        if in_check:
+            return CheckmateGameEvent(white_wins=not is_white_turn)
+
+        return StalemateGameEvent()
+
+    def has_legal_moves(self, in_check: Optional[bool] = None) -> bool:
+        """
+        Checks whether the side to move has any legal move, stopping
+        at the first one. Whether it is in check is computed unless given.
+        """
 
-                    # get it's valid moves
-                    spots = piece.get_valid_moves(self, c)
+        is_white = self.is_white_turn()
+        color = WHITE if is_white else 0
+        if in_check is None:
+            in_check = self.is_in_check(is_white)
 
-                    for spot in spots:
+        # king moves first, as they are the likeliest way out of a check
+        king = self._kings[is_white]
+        if king is not None and PIECES[self._squares[king]].get_valid_moves(self, king):
+            return True
 
-                        # check if valid move is for an opposite king
-                        target_piece = self.get(spot)
+        for sq in SQUARES:
 
-                        if target_piece \
-                                and isinstance(target_piece, King) \
-                                and piece.is_white != target_piece.is_white:
+            piece = self._squares[sq]
 
-                            if self.is_white_turn() == target_piece.is_white:
+            if piece and (piece & WHITE) == color and piece & 7 != KING \
+                    and self._get_legal_moves(sq, PIECES[piece], in_check):
+                return True
 
-                                # if king is out of spots to run - checkmate
-                                target_king_spots = target_piece.get_valid_moves(
-                                    self, spot)
-                                if target_king_spots:
-                                    return CheckGameEvent()
-                                else:
-                                    return CheckmateGameEvent(white_wins=(not target_piece.is_white))
+        return False
 
-                            # if turn is of the opposite team - checkmate
-                            # TODO so this is always wrong in terms of color
-                            else:
-                                return CheckmateGameEvent(white_wins=(not target_piece.is_white))
+    def find_forced_mate(self, moves: int, nodes: int) -> Optional[ForcedMateGameEvent]:
+        """
+        Searches for a mate the side to move can force within given amount
+        of its own moves, shortest first. Gives up once more than given
+        amount of positions were searched. Returns appropriate object if found.
+        Returns None otherwise.
+        """
+
+        budget = [nodes]
+        start = len(self.history)
+
+        try:
+            for n in range(1, moves + 1):
+                if self._forces_mate(n, budget):
+                    return ForcedMateGameEvent(white_wins=self.is_white_turn(), moves=n)
+
+        # board is left mid-search once budget runs out
+        except SearchBudgetExceeded:
+            while len(self.history) > start:
+                self.unmake()
 
         return None
 
+    def _forces_mate(self, moves: int, budget: List[int]) -> bool:
+        """
+        Whether the side to move mates within given amount of moves against
+        any defense. Searched positions are drawn from the budget, position
+        cache is bypassed so that it is not flooded by them.
+        """
+
+        is_white = self.is_white_turn()
+
+        for src, dests in self._legal_moves().items():
+            for dest in dests:
+
+                budget[0] -= 1
+                if budget[0] < 0:
+                    raise SearchBudgetExceeded()
+
+                self.make(BoardMove(src, dest))
+
+                # defender is out of moves - mate unless it is a stalemate
+                if not self.has_legal_moves():
+                    mated = self.is_in_check(not is_white)
+                    self.unmake()
+                    if mated:
+                        return True
+                    continue
+
+                # every defense has to lead into a mate
+                forced = moves > 1
+                if forced:
+                    for reply_src, reply_dests in self._legal_moves().items():
+                        for reply_dest in reply_dests:
+                            self.make(BoardMove(reply_src, reply_dest))
+                            forced = self._forces_mate(moves - 1, budget)
+                            self.unmake()
+                            if not forced:
+                                break
+                        if not forced:
+                            break
+
+                self.unmake()
+                if forced:
+                    return True
+
+        return False
+
     def is_white_turn(self) -> bool:
-        return len(self.history) % 2 == 0
+        return self.ply % 2 == 0
+
+
+def metrics_registry() -> CollectorRegistry:
+    """
+    Outputs registry of metrics to expose. Metrics of all worker processes
+    are collected if PROMETHEUS_MULTIPROC_DIR is set.
+    """
+
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def generate_metrics() -> bytes:
+    """Outputs metrics in prometheus text format."""
+
+    return generate_latest(metrics_registry())
+
+
+@contextmanager
+def count_redis_round_trips(endpoint: str):
+    """Counts redis round trips within context as made by endpoint."""
+
+    round_trips = [0]
+    token = _redis_round_trips.set(round_trips)
+
+    try:
+        yield round_trips
+    finally:
+        _redis_round_trips.reset(token)
+        REDIS_ROUND_TRIPS.labels(endpoint).observe(round_trips[0])
+
+
+def _count_redis_round_trip():
+
+    round_trips = _redis_round_trips.get()
+    if round_trips is not None:
+        round_trips[0] += 1
+
+
+class RoundTripConnection(Connection):
+
+    """Redis connection which counts round trips, each packed command being one."""
+
+    def send_packed_command(self, command, check_health=True):
+        _count_redis_round_trip()
+        super().send_packed_command(command, check_health)
+
+
+class AsyncRoundTripConnection(AsyncConnection):
+
+    """Async redis connection which counts round trips, each packed command being one."""
+
+    async def send_packed_command(self, command, check_health=True):
+        _count_redis_round_trip()
+        await super().send_packed_command(command, check_health)
+
+
+class RoundTripMiddleware:
+
+    """ASGI middleware counting redis round trips of each HTTP request by endpoint."""
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        round_trips = [0]
+        token = _redis_round_trips.set(round_trips)
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _redis_round_trips.reset(token)
+
+            # endpoint is known once request was routed
+            endpoint = scope.get("endpoint")
+            if endpoint is not None:
+                REDIS_ROUND_TRIPS.labels(endpoint.__name__).observe(round_trips[0])
+
+
+def parse_redis_hosts(hosts: str, port: int = 6379) -> List[Tuple[str, int]]:
+    """Parses comma separated list of redis nodes, each given as host[:port]."""
+
+    nodes = []
+    for host in hosts.split(","):
+        host, _, node_port = host.strip().partition(":")
+        nodes.append((host, int(node_port) if node_port else port))
+
+    return nodes
+
+
+# redis client type, RedisRouter routes sync and async clients alike
+R = TypeVar("R")
+
+
+class RedisRouter(Generic[R]):
+
+    """
+    Routes games to redis nodes by consistent hashing of game ids, so
+    adding a node only moves a share of the games over to it. All keys
+    of a game, including its endgame validator stream shard, live on the
+    node of the game.
+    """
+
+    def __init__(self, nodes: Dict[str, R], virtual_nodes: int = ROUTER_VIRTUAL_NODES) -> None:
+
+        # clients by order of node names
+        self.nodes: List[R] = list(nodes.values())
+
+        # each node owns the ring arc leading up to each of its points
+        ring = sorted((self._hash(f"{name}#{point}"), index)
+                      for index, name in enumerate(nodes) for point in range(0, virtual_nodes))
+        self._points = [point for point, _ in ring]
+        self._owners = [index for _, index in ring]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def index(self, game_id: int) -> int:
+        """Outputs index of the node which holds given game."""
+
+        point = bisect.bisect(self._points, self._hash(str(game_id)))
+        return self._owners[point % len(self._points)]
+
+    def get(self, game_id: int) -> R:
+        """Outputs client of the node which holds given game."""
+
+        return self.nodes[self.index(game_id)]
+
+
+def redis_router_from_env(client: type = Redis, pool: type = ConnectionPool,
+                          connection_class: type = RoundTripConnection, **kwargs) -> RedisRouter:
+    """
+    Builds router of the redis nodes games are spread across. First node also
+    holds data shared by all games. REDIS_HOSTS takes precedence over a single
+    REDIS_HOST. Client and pool classes are given so async clients are routed alike,
+    any other keyword arguments are passed on to each connection pool.
+    """
+
+    nodes = parse_redis_hosts(os.getenv("REDIS_HOSTS", os.getenv("REDIS_HOST", "localhost")),
+                              int(os.getenv("REDIS_PORT", "6379")))
+
+    return RedisRouter({f"{host}:{port}": client(connection_pool=pool(
+        host=host, port=port, db=0, decode_responses=True, connection_class=connection_class, **kwargs))
+        for host, port in nodes})
 
 
 def game_exists(game_id: int, redis: Redis) -> bool:
@@ -546,15 +1673,106 @@ def stream_key_from_id(id: int) -> str:
     return f"game-{id}"
 
 
+def legal_moves_key_from_id(id: int) -> str:
+    """Outputs legal moves key by game id, stored next to the game stream."""
+
+    return f"game-{id}-legal-moves"
+
+
+def ledger_key_from_id(id: int) -> str:
+    """Outputs move ledger key by game id, stored next to the game stream."""
+
+    return f"game-{id}-ledger"
+
+
+def last_game_ts(game_id: int, redis: Redis) -> str:
+    """Outputs id of the last game stream entry, "0" if game stream is empty."""
+
+    entries = redis.xrevrange(stream_key_from_id(game_id), count=1)
+    return entries[0][0] if entries else "0"
+
+
+def save_game_hash(game_id: int, redis: Redis, key: str, mapping: dict) -> bool:
+    """
+    Stores hash next to the game stream. Hash shares expiration with the game.
+    Returns False if game does not exist.
+    """
+
+    args = [v for pair in mapping.items() for v in pair]
+    return bool(redis.register_script(SAVE_GAME_HASH_SCRIPT)(
+        keys=[stream_key_from_id(game_id), key], args=args))
+
+
+def position_key_from_hash(position_hash: int) -> str:
+    """Outputs shared position cache key by zobrist hash of the position."""
+
+    return f"position-{position_hash:016x}"
+
+
+def snapshot_key_from_id(id: int) -> str:
+    """Outputs board snapshot key by game id, stored next to the game stream."""
+
+    return f"game-{id}-snapshot"
+
+
 def write_event_to_game(game_id: int, redis: Redis, event: GameEvent):
     """Writes data to game stream."""
 
-    redis.xadd(stream_key_from_id(game_id), {"data": json.dumps(event.dict())})
+    redis.xadd(stream_key_from_id(game_id), encode_game_event(event))
+
+
+def append_to_game(game_id: int, redis: Redis, ts: Union[str, int, None], events: List[GameEvent], timeout: int = 0,
+                   endgame_stream: Optional[str] = None, shards: int = 1, ply: Optional[int] = None) -> bool:
+    """
+    Atomically writes events to game stream, as long as no move was written
+    since stream entry ts. Game is set to expire if timeout is given, endgame
+    validator is notified if endgame_stream is given.
+
+    If ply is given, moves are also appended to the move ledger, and write
+    is expected to follow ply moves of the ledger instead of stream entry ts.
+    Returns False if game does not exist or has moved on.
+    """
+
+    keys = [stream_key_from_id(game_id), snapshot_key_from_id(game_id),
+            legal_moves_key_from_id(game_id), ledger_key_from_id(game_id)]
+    if endgame_stream:
+        keys.append(endgame_stream_key(endgame_stream, game_id % shards))
+
+    moves = "".join(BoardMove.from_move(event.move).to_ledger()
+                    for event in events if isinstance(event, MoveGameEvent))
+    args = [f"({ts}" if ts else "-", "" if ply is None else ply * 2, moves, game_id, timeout, GAME_EVENT_VERSION,
+            *[encode_game_event(event)["e" if GAME_EVENT_VERSION else "data"] for event in events]]
+    return bool(redis.register_script(APPEND_TO_GAME_SCRIPT)(keys=keys, args=args))
+
 
-def write_event_to_endgame_validator(game_id: int, redis: Redis, stream: str):
-    """Writes move event to endgame validator stream."""
+def endgame_stream_key(stream: str, shard: int) -> str:
+    """Outputs endgame validator stream key of a shard."""
+
+    return f"{stream}-{shard}"
+
+
+def write_event_to_endgame_validator(game_id: int, redis: Redis, stream: str, shards: int = 1):
+    """
+    Writes move event to endgame validator stream. Games are spread
+    across shards of the stream, so events of a single game always
+    land on the same shard.
+    """
+
+    redis.xadd(endgame_stream_key(stream, game_id % shards),
+               {"game_id": game_id})
+
+
+def write_event_to_analysis_worker(game_id: int, redis: Redis, stream: str, depth: Optional[int] = None,
+                                   nodes: Optional[int] = None, time: Optional[int] = None):
+    """
+    Requests analysis of the current position of a game. Budgets which are
+    not given (depth, nodes, time in milliseconds) are left to the analysis worker.
+    """
+
+    budget = {"depth": depth, "nodes": nodes, "time": time}
+    redis.xadd(stream, {"game_id": game_id,
+                        **{name: value for name, value in budget.items() if value is not None}})
 
-    redis.xadd(stream, {"game_id": game_id})
 
 def init_game(game_id: int, redis: Redis):
     """Inits empty redis stream for a game of chess."""
@@ -567,13 +1785,19 @@ def init_game(game_id: int, redis: Redis):
     ts = redis.xadd(stream_key, {"a": "b"})
     redis.xdel(stream_key, ts)
 
+    # make sure nothing is left from a previous game with the same id
+    redis.delete(snapshot_key_from_id(game_id),
+                 legal_moves_key_from_id(game_id), ledger_key_from_id(game_id))
+
 
 def expire_game(game_id: int, redis: Redis, timeout: int):
     """Sets expiration on a game stream. If timeout is 0, game is deleted."""
 
-    stream_key = stream_key_from_id(game_id)
+    keys = [stream_key_from_id(game_id), snapshot_key_from_id(game_id),
+            legal_moves_key_from_id(game_id), ledger_key_from_id(game_id)]
 
     if timeout == 0:
-        redis.delete(stream_key)
+        redis.delete(*keys)
     else:
-        redis.expire(stream_key, timeout)
+        for key in keys:
+            redis.expire(key, timeout)
@@ -0,0 +1,26 @@
+"""
+Gunicorn settings of services running multiple worker processes.
+Workers record metrics to files of a directory shared by all of them,
+so any worker serving /metrics exposes metrics of the whole service.
+"""
+
+import os
+import shutil
+
+# set before workers import prometheus_client, which picks its storage on import
+metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus")
+
+
+def on_starting(server):
+
+    # values left by a previous run would be added up with the new ones
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def child_exit(server, worker):
+
+    from prometheus_client import multiprocess
+
+    # live gauges of dead workers are no longer exposed
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3.8
+
+"""
+Load generator drives simulated games through the whole pipeline: game
+creation, moves through the gateway and move validator, check detection
+by the endgame validator and delivery of game events to websocket spectators.
+
+All services are started within this process against a local redis, so
+their environment variables apply as usual. Games play random legal moves,
+generated locally. Reported are move acknowledgement latency, time until
+moves reach spectators, check detection lag - measured from the start of
+the move request - and redis commands processed per move.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import threading
+from typing import Dict, List
+
+# services are started in-process, their modules live next to this directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for service in ["gateway", "move_validator", "endgame_validator"]:
+    sys.path.insert(0, os.path.join(ROOT, service))
+
+import httpx
+import uvicorn
+import websockets
+from chess_utils import ChessBoard, BoardMove, EventTypes, expire_game
+
+# redis of the gateway, set once services are imported
+redis = None
+
+
+class Stats:
+
+    """Latency samples of a single metric, in seconds."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.samples: List[float] = []
+
+    def add(self, sample: float):
+        self.samples.append(sample)
+
+    def report(self) -> str:
+
+        if not self.samples:
+            return f"{self.name:<22} no samples"
+
+        samples = sorted(self.samples)
+
+        def _percentile(p: float) -> float:
+            return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+
+        return f"{self.name:<22} n={len(samples):<6} p50={_percentile(0.5):8.2f}ms  " \
+               f"p95={_percentile(0.95):8.2f}ms  p99={_percentile(0.99):8.2f}ms  max={samples[-1] * 1000:8.2f}ms"
+
+
+class Server(uvicorn.Server):
+
+    """Uvicorn server which runs off the main thread."""
+
+    def install_signal_handlers(self) -> None:
+        pass
+
+    def start(self):
+
+        threading.Thread(target=self.run, daemon=True).start()
+        while not self.started:
+            time.sleep(0.05)
+
+
+class Game:
+
+    """Single simulated game along with timings of its moves."""
+
+    def __init__(self, game_id: int, seed: int) -> None:
+        self.game_id = game_id
+        self.board = ChessBoard()
+        self.random = random.Random(seed)
+
+        # start time of each move request, by ply
+        self.sent: Dict[int, float] = {}
+
+        # plies after which side to move is in check
+        self.checks: List[int] = []
+        self.over = False
+
+
+async def spectate(url: str, game: Game, stats: Dict[str, Stats], ready: asyncio.Event, count: List[int]):
+
+    """Receives game events, timing them against the moves which caused them."""
+
+    async with websockets.connect(url, open_timeout=60, max_queue=None) as websocket:
+
+        count[0] += 1
+        if count[0] == count[1]:
+            ready.set()
+
+        ply = 0
+        while True:
+
+            try:
+                event = json.loads(await websocket.recv())
+            except websockets.ConnectionClosed:
+                break
+
+            now = time.perf_counter()
+
+            if event["event"] == EventTypes.MOVE.value:
+                ply += 1
+                if ply in game.sent:
+                    stats["delivery"].add(now - game.sent[ply])
+
+            # check events follow the move which caused them
+            elif ply in game.sent:
+                stats["check"].add(now - game.sent[ply])
+
+                if event["event"] == EventTypes.CHECKMATE.value:
+                    game.over = True
+                    break
+
+
+async def play(client: httpx.AsyncClient, game: Game, plies: int, stats: Dict[str, Stats], errors: List[str]):
+
+    """Plays random legal moves until the game ends or enough plies were played."""
+
+    for ply in range(1, plies + 1):
+
+        if game.over:
+            break
+
+        moves = [(src, dest) for src, dests in game.board.legal_moves().items() for dest in dests]
+        if not moves:
+            break
+
+        move = BoardMove(*game.random.choice(moves))
+
+        game.sent[ply] = start = time.perf_counter()
+        response = await client.post(f"/game/{game.game_id}/move", json=move.to_move().dict())
+        stats["ack"].add(time.perf_counter() - start)
+
+        if response.status_code != 201:
+            errors.append(f"game {game.game_id} ply {ply}: {response.status_code} {response.text}")
+            break
+
+        game.board.make(move)
+        if game.board.is_in_check(game.board.is_white_turn()):
+            game.checks.append(ply)
+
+
+async def run(args: argparse.Namespace) -> int:
+
+    gateway_url = f"http://127.0.0.1:{args.gateway_port}"
+    stats = {name: Stats(title) for name, title in [
+        ("ack", "move ack"),
+        ("delivery", "websocket delivery"),
+        ("check", "check detection lag")
+    ]}
+    errors: List[str] = []
+    games = [Game(args.first_game_id + i, args.seed + i) for i in range(0, args.games)]
+
+    async with httpx.AsyncClient(base_url=gateway_url, timeout=60,
+                                 limits=httpx.Limits(max_connections=args.games)) as client:
+
+        # create games and wait for all spectators to join
+        for game in games:
+            expire_game(game.game_id, redis, 0)
+            response = await client.post(f"/game/{game.game_id}/create")
+            response.raise_for_status()
+
+        ready = asyncio.Event()
+        count = [0, args.games * args.spectators]
+        spectators = [asyncio.create_task(spectate(
+            f"ws://127.0.0.1:{args.gateway_port}/game/{game.game_id}/join", game, stats, ready, count))
+            for game in games for _ in range(0, args.spectators)]
+        if spectators:
+            await ready.wait()
+
+        # play all games at once
+        commands = redis.info("stats")["total_commands_processed"]
+        start = time.perf_counter()
+        await asyncio.gather(*[play(client, game, args.plies, stats, errors) for game in games])
+        elapsed = time.perf_counter() - start
+
+        # give endgame validator time to catch up before spectators leave
+        await asyncio.sleep(args.drain)
+        commands = redis.info("stats")["total_commands_processed"] - commands
+
+    for game in games:
+        expire_game(game.game_id, redis, 0)
+    await asyncio.gather(*spectators, return_exceptions=True)
+
+    moves = len(stats["ack"].samples)
+    print(f"{args.games} games, {args.spectators} spectators each, {moves} moves in {elapsed:.2f}s "
+          f"({moves / elapsed:.1f} moves/s)")
+    for metric in stats.values():
+        print(metric.report())
+    print(f"{'checks':<22} {sum(len(game.checks) for game in games)} played")
+    print(f"{'redis commands':<22} {commands / max(moves, 1):.1f} per move")
+
+    for error in errors:
+        print(f"error: {error}")
+
+    return 1 if errors else 0
+
+
+def main() -> int:
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-g", "--games", type=int, default=10,
+                        help="amount of concurrent games")
+    parser.add_argument("-s", "--spectators", type=int, default=2,
+                        help="amount of websocket spectators per game")
+    parser.add_argument("-p", "--plies", type=int, default=40,
+                        help="maximum amount of moves per game")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of random move choice")
+    parser.add_argument("--first-game-id", type=int, default=1000000,
+                        help="id of the first simulated game")
+    parser.add_argument("--gateway-port", type=int, default=8100)
+    parser.add_argument("--move-validator-port", type=int, default=8101)
+    parser.add_argument("--drain", type=float, default=2,
+                        help="seconds to wait for late events after the last move")
+    args = parser.parse_args()
+
+    # services read their configuration on import
+    os.environ.setdefault("MOVE_VALIDATOR_ENDPOINT", f"http://127.0.0.1:{args.move_validator_port}")
+    os.environ.setdefault("MOVE_VALIDATOR_MAX_CONNECTIONS", str(max(args.games, 100)))
+
+    global redis
+    import gateway
+    import move_validator
+    import endgame_validator
+    redis = gateway.redis
+    logging.disable(logging.INFO)
+
+    for app, port in [(gateway.app, args.gateway_port), (move_validator.app, args.move_validator_port)]:
+        Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")).start()
+    threading.Thread(target=endgame_validator.main, daemon=True).start()
+
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
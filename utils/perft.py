@@ -0,0 +1,110 @@
+#!/usr/bin/env python3.8
+
+"""
+Perft counts leaf nodes of the legal move tree down to a given depth.
+Counts are compared against well known results, so a single run both
+measures move generator speed and catches rule regressions.
+
+Castling, en passant and promotion are not part of the rules, so
+positions are only checked down to depths none of them can be reached at.
+"""
+
+import sys
+import time
+import argparse
+from typing import Dict, List, Tuple
+from chess_utils import ChessBoard, BoardMove, coordinate_from_square
+
+# standard positions along with their known perft counts, by depth
+POSITIONS: List[Tuple[str, str, Dict[int, int]]] = [
+    ("initial", "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+     {1: 20, 2: 400, 3: 8902, 4: 197281}),
+    ("endgame", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+     {1: 14, 2: 191}),
+    ("middlegame", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+     {1: 46, 2: 2079, 3: 89890, 4: 3894594}),
+]
+
+
+def perft(board: ChessBoard, depth: int) -> int:
+    """Counts leaf nodes of the legal move tree of given depth."""
+
+    if depth == 0:
+        return 1
+
+    nodes = 0
+    for src, dests in board.legal_moves().items():
+
+        # leaves need not be visited
+        if depth == 1:
+            nodes += len(dests)
+            continue
+
+        # moves are legal already, so there is no need to revalidate
+        for dest in dests:
+            board.make(BoardMove(src, dest))
+            nodes += perft(board, depth - 1)
+            board.unmake()
+
+    return nodes
+
+
+def divide(board: ChessBoard, depth: int) -> Dict[str, int]:
+    """Counts leaf nodes under each legal move, used to locate regressions."""
+
+    out = {}
+    for src, dests in board.legal_moves().items():
+        for dest in dests:
+            board.make(BoardMove(src, dest))
+            src_c, dest_c = coordinate_from_square(src), coordinate_from_square(dest)
+            out[f"{src_c.x},{src_c.y} -> {dest_c.x},{dest_c.y}"] = perft(board, depth - 1)
+            board.unmake()
+
+    return out
+
+
+def main() -> int:
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-d", "--depth", type=int, default=None,
+                        help="maximum depth to count (default: deepest known count)")
+    parser.add_argument("-f", "--fen", default=None,
+                        help="count given position instead of the standard ones")
+    parser.add_argument("--divide", action="store_true",
+                        help="print leaf node counts under each move of the last depth")
+    args = parser.parse_args()
+
+    positions = [("fen", args.fen, {})] if args.fen else POSITIONS
+    failed = False
+
+    for name, fen, known in positions:
+
+        max_depth = args.depth or max(known, default=3)
+        for depth in range(1, max_depth + 1):
+
+            board = ChessBoard.from_fen(fen)
+            start = time.perf_counter()
+            nodes = perft(board, depth)
+            elapsed = time.perf_counter() - start
+
+            expected = known.get(depth)
+            if expected is None:
+                result = "-"
+            elif expected == nodes:
+                result = "ok"
+            else:
+                result = f"MISMATCH (expected {expected})"
+                failed = True
+
+            print(f"{name:<12} depth {depth}  {nodes:>10} nodes  {elapsed:8.3f}s  "
+                  f"{nodes / elapsed if elapsed else 0:>10.0f} nodes/s  {result}")
+
+        if args.divide:
+            for move, nodes in divide(ChessBoard.from_fen(fen), max_depth).items():
+                print(f"  {move}: {nodes}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
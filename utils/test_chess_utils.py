@@ -0,0 +1,369 @@
+#!/usr/bin/env python3.8
+
+import os
+from chess_utils import Move, BoardMove, Coordinate, ChessBoard, PositionCache, EventTypes, MoveGameEvent, CheckGameEvent, CheckmateGameEvent, \
+    GameEvent, StalemateGameEvent, ForcedMateGameEvent, AnalysisGameEvent, \
+    square, init_game, write_event_to_game, last_game_ts, expire_game, append_to_game, snapshot_key_from_id, decode_game_event, encode_game_event, \
+    stream_key_from_id, RedisRouter, parse_redis_hosts, OpeningBook, write_opening_book, KING, QUEEN, WHITE
+from chess_fixtures import GAME, write_moves
+from redis import Redis, ResponseError
+from json import dumps
+import pickle
+import threading
+import pytest
+
+redis = Redis(host=os.getenv("REDIS_HOST", "localhost"), port=int(os.getenv("REDIS_PORT", "6379")), decode_responses=True)
+
+
+def test_from_redis_pages():
+
+    # prepare vars
+    game_id = 7
+    init_game(game_id, redis)
+
+    # write the game with events other than moves in between, and after the last move
+    for i, (src, dest) in enumerate(GAME):
+        write_moves(game_id, redis, [(src, dest)])
+        if i % 3 == 0:
+            write_event_to_game(game_id, redis, CheckGameEvent())
+    write_event_to_game(game_id, redis, CheckGameEvent())
+    ts = last_game_ts(game_id, redis)
+
+    # assert board is the same no matter how the stream is paged
+    boards = []
+    for page_size in [1, 2, None]:
+        redis.delete(snapshot_key_from_id(game_id))
+        board = ChessBoard.from_redis(game_id, redis, page_size=page_size)
+        boards.append((board.ply, board.ts, board.to_snapshot()))
+    assert boards[0] == boards[1] == boards[2]
+    assert boards[0][:2] == (len(GAME), ts)
+
+    # cleanup
+    expire_game(game_id, redis, 0)
+
+
+def test_position_cache():
+
+    # prepare vars
+    cache = PositionCache(maxsize=2, redis=redis)
+    board = ChessBoard(cache)
+    initial_hash = board.hash
+
+    # assert hash is updated incrementally and restored on undo
+    assert board.move(BoardMove(square(4, 6), square(4, 4)))
+    assert board.hash == board._compute_hash() != initial_hash
+    assert board.undo()
+    assert board.hash == initial_hash
+
+    # assert results are cached by position, first lookup
+    # was performed while validating the move
+    assert board.get_valid_moves(square(4, 6)) == [
+        square(4, 5), square(4, 4)]
+    assert board.get_valid_moves(square(4, 6)) == [
+        square(4, 5), square(4, 4)]
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # assert redis tier serves other processes' results
+    other_cache = PositionCache(redis=redis)
+    assert ChessBoard(other_cache).get_valid_moves(square(4, 6)) == [
+        square(4, 5), square(4, 4)]
+    assert (other_cache.redis_hits, other_cache.misses) == (1, 0)
+
+    # assert least recently used entries are evicted
+    board.find_checks()
+    board.get_valid_moves(square(1, 7))
+    assert len(cache._entries) == 2
+    assert (initial_hash, f"moves-{square(4, 6)}") not in cache._entries
+
+    # assert callers changing results do not alter cached ones
+    board.legal_moves()[square(4, 6)].append(square(4, 3))
+    assert board.legal_moves() == ChessBoard().legal_moves()
+
+    # assert concurrent lookups and evictions leave the cache consistent
+    cache = PositionCache(maxsize=8)
+
+    def _hammer(offset: int):
+        for i in range(0, 2000):
+            if cache.get(offset + i % 32, "f") is PositionCache.MISS:
+                cache.put(offset + i % 32, "f", i)
+
+    threads = [threading.Thread(target=_hammer, args=(i * 16,)) for i in range(0, 4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(cache._entries) == 8 and cache.hits + cache.misses == 8000
+
+
+def test_append_to_game():
+
+    # prepare vars
+    game_id = 4
+    moves = [
+        Move(src_coordinate=Coordinate(x=4, y=6), dest_coordinate=Coordinate(x=4, y=4)),
+        Move(src_coordinate=Coordinate(x=4, y=1), dest_coordinate=Coordinate(x=4, y=3)),
+    ]
+
+    # assert write to non-existing game is rejected
+    assert not append_to_game(game_id, redis, 0, [MoveGameEvent(move=moves[0])])
+
+    # two boards are built off the same game
+    init_game(game_id, redis)
+    first, second = ChessBoard.from_redis(game_id, redis), ChessBoard.from_redis(game_id, redis)
+
+    # assert only the first of the concurrent moves is written
+    assert append_to_game(game_id, redis, first.ts, [MoveGameEvent(move=moves[0])])
+    assert not append_to_game(game_id, redis, second.ts, [MoveGameEvent(move=moves[0])])
+
+    # assert events other than moves do not reject the write
+    board = ChessBoard.from_redis(game_id, redis)
+    redis.xadd(stream_key_from_id(game_id), {"data": dumps(CheckGameEvent().dict())})
+    assert append_to_game(game_id, redis, board.ts, [MoveGameEvent(move=moves[1])])
+    assert ChessBoard.from_redis(game_id, redis).ply == 2
+
+    # assert entries of unknown format versions are not mistaken for other events
+    board = ChessBoard.from_redis(game_id, redis)
+    redis.xadd(stream_key_from_id(game_id), {"v": 2, "e": "c"})
+    with pytest.raises(ResponseError):
+        append_to_game(game_id, redis, board.ts, [MoveGameEvent(move=moves[0])])
+
+    # cleanup
+    expire_game(game_id, redis, 0)
+
+
+def test_event_codec():
+
+    # prepare vars, along with their compact encoding
+    events = [
+        (MoveGameEvent(move=Move(src_coordinate=Coordinate(x=6, y=7), dest_coordinate=Coordinate(x=5, y=5))), "mn]"),
+        (CheckGameEvent(), "c"),
+        (CheckmateGameEvent(white_wins=True), "x1"),
+        (CheckmateGameEvent(white_wins=False), "x0"),
+        (StalemateGameEvent(), "s"),
+        (ForcedMateGameEvent(white_wins=True, moves=3), "f13"),
+        (AnalysisGameEvent(ply=3, depth=2, nodes=120, score=-100000, mate=0), 'a{"ply":3,"depth":2,"nodes":120,"score":-100000,"mate":0,"best_move":null}'),
+        (AnalysisGameEvent(ply=4, depth=3, nodes=812, score=35, best_move=Move(
+            src_coordinate=Coordinate(x=6, y=7), dest_coordinate=Coordinate(x=5, y=5))),
+         'a{"ply":4,"depth":3,"nodes":812,"score":35,"mate":null,"best_move":'
+         '{"src_coordinate":{"x":6,"y":7},"dest_coordinate":{"x":5,"y":5}}}')
+    ]
+
+    for event, encoded in events:
+
+        # assert compact format is as expected and decodes back
+        fields = encode_game_event(event)
+        assert fields == {"v": 1, "e": encoded}
+        assert decode_game_event(fields) == event.dict()
+
+        # assert legacy entries are still accepted
+        assert decode_game_event(encode_game_event(event, 0)) == event.dict()
+
+    # assert unknown versions and events are rejected rather than misread
+    with pytest.raises(ValueError):
+        encode_game_event(CheckGameEvent(), 2)
+    with pytest.raises(TypeError):
+        encode_game_event(GameEvent(event=EventTypes.CHECK.value))
+    for fields in [{"v": "2", "e": "c"}, {"v": "1", "e": "z"}]:
+        with pytest.raises(ValueError):
+            decode_game_event(fields)
+    with pytest.raises(ValueError):
+        BoardMove.from_fields({"v": "2", "e": "mn]"})
+
+
+def test_redis_router():
+
+    # prepare vars
+    nodes = parse_redis_hosts("redis-0, redis-1:6380, redis-2")
+    router = RedisRouter({f"{host}:{port}": f"{host}:{port}" for host, port in nodes})
+    grown = RedisRouter({**{f"{host}:{port}": f"{host}:{port}" for host, port in nodes}, "redis-3:6379": "redis-3:6379"})
+
+    # assert hosts are parsed with default port
+    assert nodes == [("redis-0", 6379), ("redis-1", 6380), ("redis-2", 6379)]
+
+    # assert games are spread across all nodes
+    games = range(0, 3000)
+    assert {router.get(game_id) for game_id in games} == {f"{host}:{port}" for host, port in nodes}
+
+    # assert new node only takes games over, games do not move between old nodes
+    moved = [game_id for game_id in games if router.get(game_id) != grown.get(game_id)]
+    assert 0 < len(moved) < len(games) / 2
+    assert all(grown.get(game_id) == "redis-3:6379" for game_id in moved)
+
+
+def test_from_fen():
+
+    # assert initial position matches a new board
+    board = ChessBoard.from_fen("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1")
+    assert board.to_snapshot() == ChessBoard().to_snapshot()
+    assert board.hash == ChessBoard().hash and board.is_white_turn()
+
+    # assert side to move is kept in ply
+    board = ChessBoard.from_fen("rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1")
+    assert board.ply == 1 and not board.is_white_turn()
+    assert board.get(square(4, 4)).is_white and not board.get(square(4, 6))
+
+    # assert malformed placement is rejected
+    try:
+        ChessBoard.from_fen("rnbqkbnr/pppppppp/8/8/8/PPPPPPPP/RNBQKBNR w - - 0 1")
+        assert False
+    except ValueError:
+        pass
+
+
+def test_make_unmake():
+
+    # prepare vars
+    board = ChessBoard.from_fen("4k3/8/8/8/8/8/4q3/4K3 w - - 0 1")
+    snapshot, position_hash = board.to_snapshot(), board.hash
+
+    # assert king capturing the queen is recorded with everything needed to take it back
+    history_move = board.make(BoardMove(square(4, 7), square(4, 6)))
+    assert (history_move.src_piece, history_move.dest_piece) == (KING | WHITE, QUEEN)
+    assert board._kings[True] == square(4, 6) and board.ply == 1
+
+    # assert unmake restores the position, including the king
+    assert board.unmake() is history_move
+    assert board.to_snapshot() == snapshot and board.hash == position_hash
+    assert board._kings[True] == square(4, 7) and board.ply == 0
+
+    # assert empty history can not be unmade
+    try:
+        board.unmake()
+        assert False
+    except IndexError:
+        pass
+    assert not board.undo()
+
+
+def test_position():
+
+    # prepare vars
+    board = ChessBoard()
+    moves = [BoardMove(square(6, 7), square(5, 5)), BoardMove(square(6, 0), square(5, 2)),
+             BoardMove(square(1, 7), square(2, 5)), BoardMove(square(1, 0), square(2, 2))]
+
+    # assert position round trips through the board
+    position = board.to_position()
+    assert len(position.squares) == 64 and position.white_to_move
+    restored = ChessBoard.from_position(position)
+    assert restored.to_snapshot() == board.to_snapshot() and restored.hash == board.hash
+
+    # assert position moves along with the board, leaving the original untouched
+    for move in moves:
+        board.make(move)
+    after = board.to_position()
+    assert after == position.make(moves[0]).make(moves[1]).make(moves[2]).make(moves[3])
+    assert position == ChessBoard().to_position()
+
+    # assert transposed positions are equal, and are found by each other
+    transposed = ChessBoard()
+    for move in [moves[2], moves[3], moves[0], moves[1]]:
+        transposed.make(move)
+    assert transposed.to_position() == after and after in {transposed.to_position()}
+
+    # assert positions survive being pickled, and side to move sets ply
+    assert pickle.loads(pickle.dumps(after)) == after
+    assert ChessBoard.from_position(after, ply=4).ply == 4
+    assert ChessBoard.from_position(position.make(moves[0])).ply == 1
+
+    # assert copies are independent of their origin
+    copy = board.copy()
+    copy.make(BoardMove(square(4, 6), square(4, 4)))
+    assert board.to_position() == after and copy.to_position() != after
+    assert copy.unmake() and copy.to_position() == after and copy.hash == board.hash
+
+
+def test_is_attacked():
+
+    # prepare vars
+    board = ChessBoard.from_fen("1R1N3k/8/8/3p4/4P2N/8/8/K7 w - - 0 1")
+
+    for sq, by_white, attacked in [
+
+        # pawns only attack diagonally forward
+        (square(3, 3), True, True), (square(4, 3), True, False), (square(3, 5), True, False),
+        (square(2, 4), False, True), (square(4, 4), False, True), (square(2, 2), False, False),
+
+        # sliders stop at the first piece, own pieces included
+        (square(2, 0), True, True), (square(4, 0), True, False), (square(1, 7), True, True),
+
+        # knights and kings jump to their squares only
+        (square(4, 2), True, True), (square(5, 1), True, True), (square(5, 3), True, True),
+        (square(0, 6), True, True), (square(6, 1), False, True), (square(7, 1), False, True),
+
+        # nothing wraps around board edges
+        (square(0, 5), True, False), (square(0, 3), True, False), (square(7, 6), True, False),
+        (square(0, 1), False, False)
+    ]:
+        assert board.is_attacked(sq, by_white) == attacked, (sq, by_white)
+
+    # assert kings are in check by pawns of the other side only
+    assert not board.is_in_check(True) and not board.is_in_check(False)
+    assert ChessBoard.from_fen("7k/6P1/8/8/8/8/8/K7 b - - 0 1").is_in_check(False)
+    assert not ChessBoard.from_fen("7K/6p1/8/8/8/8/8/k7 w - - 0 1").is_in_check(True)
+    assert ChessBoard.from_fen("k7/8/8/8/8/8/6p1/7K w - - 0 1").is_in_check(True)
+
+
+def test_find_checks():
+
+    # assert checks are told apart from mates by every way out of them
+    for fen, event in [
+        ("R5k1/5ppp/8/8/8/8/8/6K1 b - - 0 1", CheckmateGameEvent(white_wins=True)),
+        ("R5k1/5ppp/8/8/8/8/1r6/6K1 b - - 0 1", CheckGameEvent()),
+        ("R5k1/5ppp/8/8/8/8/r7/6K1 b - - 0 1", CheckGameEvent()),
+        ("R5k1/6pp/8/8/8/8/8/6K1 b - - 0 1", CheckGameEvent()),
+        ("6rk/5Npp/8/8/8/8/8/6K1 b - - 0 1", CheckmateGameEvent(white_wins=True)),
+        ("7k/5Q2/6K1/8/8/8/8/8 b - - 0 1", StalemateGameEvent()),
+        ("7k/8/6K1/8/8/8/8/5Q2 b - - 0 1", None)
+    ]:
+        assert ChessBoard.from_fen(fen).find_checks() == event
+
+
+def test_find_forced_mate():
+
+    # prepare vars
+    board = ChessBoard.from_fen("2rkr3/2ppp3/2n1n3/R2R4/8/8/3K4/8 w - - 0 1")
+    snapshot = board.to_snapshot()
+
+    # assert shortest forced mate is found, leaving the board as it was
+    assert board.find_forced_mate(3, 10000) == ForcedMateGameEvent(white_wins=True, moves=2)
+    assert board.to_snapshot() == snapshot and not board.history
+
+    # assert search gives up once out of budget, leaving the board as it was
+    assert board.find_forced_mate(3, 10) is None
+    assert board.to_snapshot() == snapshot and not board.history
+
+
+def test_opening_book(tmp_path):
+
+    # prepare vars
+    path = str(tmp_path / "book.bin")
+    board = ChessBoard()
+    e4 = BoardMove(square(4, 6), square(4, 4))
+    d4 = BoardMove(square(3, 6), square(3, 4))
+    played = {(e4.src, e4.dest): 2, (d4.src, d4.dest): 1}
+
+    # book holds initial position, with all of its legal moves in generation order
+    write_opening_book(path, {board.hash: [(src, dest, played.get((src, dest), 0))
+                                           for src, dests in board.legal_moves().items() for dest in dests]})
+    book = OpeningBook(path)
+    assert len(book) == 20
+
+    # assert book positions are answered out of the book
+    board = ChessBoard(cache=PositionCache(book=book))
+    assert board.legal_moves() == ChessBoard().legal_moves()
+    assert board.get_valid_moves(square(0, 6)) == [square(0, 5), square(0, 4)]
+    assert board.book_moves() == [(e4, 2), (d4, 1)]
+
+    # assert other positions and pieces of the side not to move are generated as usual
+    assert board.get_valid_moves(square(1, 0)) == [square(0, 2), square(2, 2)]
+    board.make(e4)
+    assert book.legal_moves(board.hash) is None and board.book_moves() == []
+    assert sum(len(dests) for dests in board.legal_moves().values()) == 20
+
+    # assert other files are rejected
+    book.close()
+    with open(path, "wb") as f:
+        f.write(b"not a book")
+    with pytest.raises(ValueError):
+        OpeningBook(path)